@@ -0,0 +1,241 @@
+"""
+Throughput benchmark of every preprocessing stage on a synthetic corpus.
+    1. make_corpus writes count clean *.pcm / *.wav files and noise *.wav files into a temporary folder
+    2. every stage runs in its own fresh process, so peak RSS belongs to that stage only
+    3. the result is printed (or written with --out) as json
+        stage, files, audio_seconds, seconds (setup = constructor and file discovery, run = processing),
+        files_per_second, audio_seconds_per_second, peak_rss_mb (stage process), children_peak_rss_mb (worker pool)
+    codec_<name> stages encode the clean corpus (as float) with one output codec (codec.py) on "workers" write threads,
+    then read every file back. They add read_audio_seconds_per_second, output_mb and size_ratio (output / float32 wav size).
+
+python bench.py --count 200 --duration 4 --sr 16000 --dtype int16 --workers 4 --out bench.json
+"""
+import os, sys, json, time, shutil, argparse, resource, tempfile, traceback, multiprocessing
+import numpy as np
+
+import scipy
+import scipy.io.wavfile
+
+from codec import available_codecs
+
+STAGES = ["pcm2wav", "resample_librosa", "resample_scipy", "resample_poly", "resample_stream", "mixture", "mixture_rir"] + \
+         ["codec_" + name for name in available_codecs()]
+
+def make_corpus (path, count = 100, duration = 4.0, sampling_rate = 16000, dtype = "int16", noise_count = 20, seed = 0):
+    """
+    path/pcm/speaker/*.pcm : int16 raw sound (pcm2wav input)
+    path/clean/*.wav       : the same sound as wav file of dtype (resampler and mixture input)
+    path/noise/*.wav       : noise wav files of dtype
+    path/rir/*.wav         : float32 room impulse responses (exponentially decaying noise, 0.1 ~ 0.5 s)
+    The length of every file is drawn around duration (0.5x ~ 1.5x).
+    """
+    rng = np.random.RandomState(seed)
+    for folder in ["pcm/speaker", "clean", "noise", "rir"]:
+        os.makedirs(os.path.join(path, folder), exist_ok = True)
+
+    def sound (seconds):
+        frames = max(1, int(seconds * sampling_rate * rng.uniform(0.5, 1.5)))
+        data   = np.clip(rng.randn(frames) * 0.1, -1, 1)
+        if dtype == "int16":
+            return (data * 32767).astype(np.int16)
+
+        return data.astype(np.float32)
+
+    audio_seconds = 0.0
+    for index in range(count):
+        data = sound(duration)
+        scipy.io.wavfile.write(os.path.join(path, "clean", "{:07d}.wav".format(index)), sampling_rate, data)
+        if data.dtype != np.int16:
+            data = (data * 32767).astype(np.int16)
+        data.tofile(os.path.join(path, "pcm", "speaker", "{:07d}.pcm".format(index)))
+        audio_seconds += len(data) / sampling_rate
+
+    for index in range(noise_count):
+        scipy.io.wavfile.write(os.path.join(path, "noise", "{:05d}.wav".format(index)), sampling_rate, sound(duration))
+
+    for index in range(noise_count):
+        frames = int(sampling_rate * rng.uniform(0.1, 0.5))
+        decay  = np.exp(-6.9 * np.arange(frames) / frames)
+        scipy.io.wavfile.write(os.path.join(path, "rir", "{:05d}.wav".format(index)), sampling_rate,
+                               (rng.randn(frames) * decay).astype(np.float32))
+
+    return audio_seconds
+
+
+def run_stage (stage, path, config):
+    """
+    One stage on the corpus in path, returns the timing of its phases
+    """
+    from pcm2wav import pcm2wav
+    from resample import resampler
+    from mixture import data_mixture
+    from codec import get_codec, read_sound
+    from write_behind import write_behind
+
+    output = os.path.join(path, "out_" + stage)
+    timing = {}
+
+    start = time.time()
+    if stage == "pcm2wav":
+        factory = pcm2wav(load_path = os.path.join(path, "pcm"), save_path = output)
+        timing["setup"] = time.time() - start
+
+        start = time.time()
+        factory.start(sampling_rate = config["sampling_rate"], workers = config["workers"])
+
+    elif stage.startswith("resample_"):
+        factory = resampler(base_file_path    = os.path.join(path, "clean"),
+                            save_file_path    = output,
+                            save_file_name    = "clean",
+                            original_sampling = config["sampling_rate"],
+                            target_sampling   = config["target_sampling"])
+        timing["setup"] = time.time() - start
+
+        start = time.time()
+        factory.data_save(option = stage[len("resample_"):], workers = config["workers"])
+
+    elif stage in ["mixture", "mixture_rir"]:
+        factory = data_mixture(clean_source_path = os.path.join(path, "clean"),
+                               noise_source_path = os.path.join(path, "noise"),
+                               save_file_path    = output,
+                               SNR               = 0,
+                               original_sampling = config["sampling_rate"],
+                               target_sampling   = config["sampling_rate"],
+                               split_length      = config["split_length"],
+                               rir_path          = os.path.join(path, "rir") if stage == "mixture_rir" else None)
+        timing["setup"] = time.time() - start
+
+        start = time.time()
+        factory.save(None, workers = config["workers"])
+
+    elif stage.startswith("codec_"):
+        codec  = get_codec(stage[len("codec_"):])
+        sounds = []
+        for name in sorted(os.listdir(os.path.join(path, "clean"))):
+            _, sound = read_sound(os.path.join(path, "clean", name))
+            if np.issubdtype(sound.dtype, np.integer):
+                sound = sound / np.float32(32768)
+            sounds.append(np.asarray(sound, dtype = np.float32))
+        os.makedirs(output, exist_ok = True)
+        files  = [os.path.join(output, "{:07d}".format(index) + codec.extension) for index in range(len(sounds))]
+        timing["setup"] = time.time() - start
+
+        # Encoding runs on the write threads, as in mixture.py and resample.py
+        start = time.time()
+        with write_behind(workers = config["workers"], depth = 64) as writer:
+            for file, sound in zip(files, sounds):
+                writer.submit(codec.write, file, sound, config["sampling_rate"])
+        timing["run"] = time.time() - start
+
+        start = time.time()
+        for file in files:
+            codec.read(file)
+        timing["read"] = time.time() - start
+
+        return timing
+
+    else:
+        raise ValueError("unknown stage " + str(stage))
+
+    timing["run"] = time.time() - start
+
+    return timing
+
+
+def stage_process (stage, path, config, results):
+    # The stages print progress, keep stdout clean for the json result
+    sys.stdout = open(os.devnull, "w")
+    result     = {"stage" : stage}
+
+    try:
+        result["seconds"] = run_stage(stage, path, config)
+    except Exception as error:
+        result["error"] = "".join(traceback.format_exception_only(type(error), error)).strip()
+
+    result["peak_rss_mb"]          = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["children_peak_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    results.put(result)
+
+
+def bench (stages = STAGES, count = 100, duration = 4.0, sampling_rate = 16000, target_sampling = 16000, dtype = "int16",
+           split_length = 16384, workers = 1, path = None, seed = 0):
+    config = {"count"           : count,
+              "duration"        : duration,
+              "sampling_rate"   : sampling_rate,
+              "target_sampling" : target_sampling,
+              "dtype"           : dtype,
+              "split_length"    : split_length,
+              "workers"         : workers}
+
+    keep = path is not None
+    path = path if keep else tempfile.mkdtemp(prefix = "speech_bench_")
+
+    try:
+        start         = time.time()
+        audio_seconds = make_corpus(path, count, duration, sampling_rate, dtype, seed = seed)
+        corpus_time   = time.time() - start
+
+        results = []
+        context = multiprocessing.get_context("spawn")
+        for stage in stages:
+            queue   = context.Queue()
+            process = context.Process(target = stage_process, args = (stage, path, config, queue))
+            process.start()
+            result  = queue.get()
+            process.join()
+
+            if "seconds" in result:
+                run     = max(result["seconds"]["run"], 1e-9)
+                seconds = audio_seconds
+                if stage.startswith("mixture"):
+                    # The mixture output is one split_length example per clean file
+                    seconds = count * split_length / sampling_rate
+                result["files"]                    = count
+                result["audio_seconds"]            = seconds
+                result["files_per_second"]         = count / run
+                result["audio_seconds_per_second"] = seconds / run
+                if stage.startswith("codec_"):
+                    output = os.path.join(path, "out_" + stage)
+                    size   = sum(os.path.getsize(os.path.join(output, name)) for name in os.listdir(output))
+                    result["read_audio_seconds_per_second"] = seconds / max(result["seconds"]["read"], 1e-9)
+                    result["output_mb"]                     = size / 2 ** 20
+                    # A float32 wav is 4 bytes per sample (headers left out)
+                    result["size_ratio"]                    = size / (4 * seconds * sampling_rate)
+            results.append(result)
+
+    finally:
+        if not(keep):
+            shutil.rmtree(path, ignore_errors = True)
+
+    return {"config" : config, "corpus_seconds" : corpus_time, "results" : results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'SETTING OPTION')
+    parser.add_argument("--stages",   type = str,   default = ",".join(STAGES), help = "Input comma separated stages")
+    parser.add_argument("--count",    type = int,   default = 100,     help = "Input number of clean files")
+    parser.add_argument("--duration", type = float, default = 4.0,     help = "Input mean seconds per file")
+    parser.add_argument("--sr",       type = int,   default = 16000,   help = "Input sampling rate of the corpus")
+    parser.add_argument("--ts",       type = int,   default = 16000,   help = "Input target sampling rate of resampling")
+    parser.add_argument("--dtype",    type = str,   default = "int16", help = "Input wav dtype int16 or float32")
+    parser.add_argument("--length",   type = int,   default = 16384,   help = "Input split length of mixture")
+    parser.add_argument("--workers",  type = int,   default = 1,       help = "Input workers of every stage")
+    parser.add_argument("--path",     type = str,   default = None,    help = "Input corpus folder (kept), temporary if empty")
+    parser.add_argument("--out",      type = str,   default = None,    help = "Input json output file, stdout if empty")
+    args = parser.parse_args()
+
+    report = bench(stages          = args.stages.split(","),
+                   count           = args.count,
+                   duration        = args.duration,
+                   sampling_rate   = args.sr,
+                   target_sampling = args.ts,
+                   dtype           = args.dtype,
+                   split_length    = args.length,
+                   workers         = args.workers,
+                   path            = args.path)
+
+    if args.out is None:
+        print(json.dumps(report, indent = 4))
+    else:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent = 4)
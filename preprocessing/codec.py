@@ -0,0 +1,135 @@
+"""
+Output codecs shared by data_mixture, resampler and pipeline.
+    wav-float32 : 32 bit float wav (the old output)
+    wav-int16   : 16 bit PCM wav, half the size
+    flac        : lossless FLAC of the 16 bit samples (soundfile, optional), usually well below wav-int16
+
+Every codec takes float sound (-1 ~ 1) and converts it to its own samples while encoding,
+so the conversion runs on the writer threads or processes together with the encoding.
+    codec.write(path, sound, sampling_rate)   : one file
+    codec.read(path)                          : sampling_rate, samples
+    codec.stream(path, sampling_rate, channels): writer for block by block output (write(block), close)
+
+get_codec(name) returns a registered codec, register_codec adds a new one.
+"""
+import scipy
+import scipy.io.wavfile
+
+from wav_io import wav_writer, convert_samples
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+class sample_writer ():
+    """
+    Convert every float block to the samples of the codec, then append it to writer
+    """
+    def __init__ (self, writer, dtype):
+        self.writer = writer
+        self.dtype  = dtype
+
+
+    def write (self, block):
+        self.writer.write(convert_samples(block, self.dtype))
+
+
+    def close (self):
+        self.writer.close()
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, *exc):
+        self.close()
+
+
+class wav_codec ():
+    extension = ".wav"
+
+    def __init__ (self, name, dtype):
+        self.name  = name
+        self.dtype = dtype
+
+
+    def write (self, path, sound, sampling_rate):
+        scipy.io.wavfile.write(path, sampling_rate, convert_samples(sound, self.dtype))
+
+
+    def read (self, path):
+        return scipy.io.wavfile.read(path)
+
+
+    def stream (self, path, sampling_rate, channels = 1):
+        return sample_writer(wav_writer(path, sampling_rate, channels, self.dtype), self.dtype)
+
+
+class flac_codec ():
+    """
+    FLAC keeps the 16 bit samples exactly (the same values as wav-int16), libsndfile does the encoding
+    """
+    extension = ".flac"
+    name      = "flac"
+    dtype     = "int16"
+
+    def write (self, path, sound, sampling_rate):
+        soundfile.write(path, convert_samples(sound, self.dtype), sampling_rate, format = "FLAC", subtype = "PCM_16")
+
+
+    def read (self, path):
+        sound, sampling_rate = soundfile.read(path, dtype = self.dtype)
+
+        return sampling_rate, sound
+
+
+    def stream (self, path, sampling_rate, channels = 1):
+        writer = soundfile.SoundFile(path, mode = "w", samplerate = sampling_rate, channels = channels,
+                                     format = "FLAC", subtype = "PCM_16")
+
+        return sample_writer(writer, self.dtype)
+
+
+codecs = {}
+
+def register_codec (codec):
+    codecs[codec.name] = codec
+
+
+def get_codec (name):
+    if name not in codecs:
+        raise ValueError("codec must be one of " + ", ".join(sorted(codecs)) + ", not " + str(name))
+    if name == "flac" and soundfile is None:
+        raise ImportError("the flac codec needs soundfile (pip install soundfile)")
+
+    return codecs[name]
+
+
+def available_codecs ():
+    return [name for name in sorted(codecs) if name != "flac" or soundfile is not None]
+
+
+def extensions ():
+    """
+    File extensions of every registered codec (sound sources to index)
+    """
+    return sorted(set(codec.extension for codec in codecs.values()))
+
+
+def read_sound (path):
+    """
+    scipy.io.wavfile.read for any registered codec, chosen by the file extension
+        return sampling_rate, samples
+    """
+    for codec in codecs.values():
+        if codec.extension != ".wav" and path.lower().endswith(codec.extension):
+            return get_codec(codec.name).read(path)
+
+    return scipy.io.wavfile.read(path)
+
+
+register_codec(wav_codec("wav-float32", "float32"))
+register_codec(wav_codec("wav-int16",   "int16"))
+register_codec(flac_codec())
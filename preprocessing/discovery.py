@@ -0,0 +1,172 @@
+import os, json, uuid, heapq, struct
+import natsort
+from concurrent.futures import ThreadPoolExecutor
+
+from wav_io import read_wav_header
+
+class file_index ():
+    """
+    Shared file discovery for pcm2wav, resampler and data_mixture (replaces walk_filename and read_directory).
+        1. Directories are scanned with os.scandir on a thread pool, one directory per task.
+        2. path, size, mtime and the wav header (wav_io.read_wav_header) of every file are kept in index_path (json).
+        3. refresh on a later run only lists directories whose mtime changed, the others are taken from the index.
+           (A new, deleted or renamed file changes the mtime of its directory. A file rewritten in place does not,
+            use verify_files = True to stat every file again in that case.)
+           entry and header stat the file again anyway, a file rewritten in place gets a new header there.
+        4. The natural order (natsort) is stored too, so a run without new files does not sort at all.
+
+    def refresh : scan (or rescan) root and save the index
+    def files   : naturally ordered file paths, filtered by extensions
+    def entry   : size, mtime and header of a file, probed again if the file changed since the index was made
+    def header  : wav header of a file (None if it is not a readable wav file)
+    """
+    ignore = ["desktop.ini", ".DS_Store"]
+
+    def __init__ (self, root, index_path = None, extensions = None, workers = 16,
+                        probe_headers = True, verify_files = False):
+        '''
+        arguments:
+            root          : folder to scan (recursive)
+            index_path    : json file of the persisted index, None keeps it in memory only
+            extensions    : list of file extensions to keep (".wav", ".pcm"), None keeps every file
+            workers       : scandir threads (the work is waiting on the file system)
+            probe_headers : read the header of every *.wav file
+            verify_files  : stat every file even in directories whose mtime did not change
+        '''
+        self.root          = root
+        self.index_path    = index_path
+        self.extensions    = None if extensions is None else tuple(extension.lower() for extension in extensions)
+        self.workers       = workers
+        self.probe_headers = probe_headers
+        self.verify_files  = verify_files
+
+        self.dirs      = {}
+        self.order     = []
+        self.locations = {}
+
+        if self.index_path is not None and os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            if index.get("root") == self.root and index.get("probe_headers") == self.probe_headers:
+                self.dirs  = index["dirs"]
+                self.order = index["order"]
+
+        self.refresh()
+
+
+    def scan (self, path, cached):
+        """
+        One directory: its mtime, its files (size, mtime, header) and its sub directories
+        """
+        mtime_ns = os.stat(path).st_mtime_ns
+        if cached is not None and cached["mtime_ns"] == mtime_ns and not(self.verify_files):
+            return path, cached
+
+        old_files = {} if cached is None else cached["files"]
+        files     = {}
+        subdirs   = []
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks = True):
+                    subdirs.append(entry.path)
+                    continue
+                if entry.name in self.ignore:
+                    continue
+
+                files[entry.name] = self.probe(entry.path, entry.stat(), old_files.get(entry.name))
+
+        return path, {"mtime_ns" : mtime_ns, "files" : files, "subdirs" : subdirs}
+
+
+    def probe (self, path, stat, old = None):
+        """
+        Entry of one file, old is reused if size and mtime did not change
+        """
+        if old is not None and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns:
+            return old
+
+        header = None
+        if self.probe_headers and path.lower().endswith(".wav"):
+            try:
+                header = read_wav_header(path)
+            except (ValueError, struct.error, OSError):
+                header = None
+
+        return {"size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns, "header" : header}
+
+
+    def refresh (self):
+        if not(os.path.isdir(self.root)):
+            raise FileNotFoundError(str(self.root) + " is not a folder")
+
+        dirs    = {}
+        pending = [self.root]
+
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            while pending:
+                results = executor.map(lambda path : self.scan(path, self.dirs.get(path)), pending)
+                pending = []
+                for path, entry in results:
+                    dirs[path] = entry
+                    pending.extend(entry["subdirs"])
+
+        self.dirs = dirs
+        self.sort()
+        self.save()
+
+
+    def sort (self):
+        """
+        Keep the stored natural order, drop removed files and merge in only the new ones
+        """
+        self.locations = {os.path.join(path, name) : (path, name) for path, entry in self.dirs.items() for name in entry["files"]}
+        kept     = [path for path in self.order if path in self.locations]
+        added    = natsort.natsorted(set(self.locations).difference(kept), reverse = False)
+        if added:
+            key  = natsort.natsort_keygen()
+            kept = list(heapq.merge(kept, added, key = key))
+        self.order = kept
+
+
+    def save (self):
+        if self.index_path is None:
+            return
+
+        folder = os.path.dirname(self.index_path)
+        if folder and not(os.path.isdir(folder)):
+            os.makedirs(folder)
+
+        # Job shards on other machines may save the same index at the same time, each writes its own temporary file
+        temp_path = self.index_path + "." + uuid.uuid4().hex + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"root" : self.root, "probe_headers" : self.probe_headers, "dirs" : self.dirs, "order" : self.order}, f)
+        os.replace(temp_path, self.index_path)
+
+
+    def files (self):
+        if self.extensions is None:
+            return list(self.order)
+
+        return [path for path in self.order if path.lower().endswith(self.extensions)]
+
+
+    def entry (self, path):
+        folder, name = self.locations[path]
+        files        = self.dirs[folder]["files"]
+
+        # The directory mtime does not see a file rewritten in place, its own size and mtime do
+        try:
+            files[name] = self.probe(path, os.stat(path), files[name])
+        except OSError:
+            pass
+
+        return files[name]
+
+
+    def header (self, path):
+        return self.entry(path)["header"]
+
+
+    def headers (self):
+        return {path : self.header(path) for path in self.files()}
@@ -0,0 +1,185 @@
+import os, json
+import numpy as np
+from tqdm import tqdm
+
+import scipy
+import scipy.io.wavfile
+
+from codec import read_sound
+
+class energy_index ():
+    """
+    Cumulative sum of squares of every source, so the energy (RMS) of any window is one subtraction.
+        index_path/energy.npy       : the cumulative arrays of all sources, one after another
+        index_path/energy_index.npy : (N, 3) int64, offset in energy.npy, number of samples and block of each source
+        index_path/energy_files.json: [path, size, mtime_ns] of each source (a changed source list or block rebuilds the index)
+
+    energy[offset + k] = sum of squares of the first k * block samples (the last entry is the whole source).
+    block = 1 is exact for 8 and 16 bit sources (int64, so no rounding at all; 32 bit squares would overflow int64
+    after a few samples, so wider integer and float sources are summed in float64), block > 1 stores one value per block
+    and a window edge inside a block is interpolated. That is 1 / block of the memory and accurate enough
+    to find silent windows.
+
+    def window_energy : sum of squares of [offset, offset + length), clipped to the source
+    def window_rms    : RMS of the same window zero padded to "length" samples (as data_crop pads it)
+    def build         : one pass over the sources (decoded one at a time), written under temporary names
+    """
+    energy_name = "energy.npy"
+    index_name  = "energy_index.npy"
+    files_name  = "energy_files.json"
+
+    def __init__ (self, index_path):
+        self.index_path = index_path
+        self.open()
+
+
+    def open (self):
+        self.energy = np.load(os.path.join(self.index_path, self.energy_name), mmap_mode = "r")
+        self.index  = np.load(os.path.join(self.index_path, self.index_name))
+
+        with open(os.path.join(self.index_path, self.files_name), "r") as f:
+            self.file_state = json.load(f)
+        self.rows = {state[0] : row for row, state in enumerate(self.file_state)}
+
+
+    def __getstate__ (self):
+        return {"index_path" : self.index_path}
+
+
+    def __setstate__ (self, state):
+        self.index_path = state["index_path"]
+        self.open()
+
+
+    def __len__ (self):
+        return len(self.index)
+
+
+    def row (self, path):
+        return self.rows[path]
+
+
+    def cumulative (self, row, position):
+        offset, frames, block = (int(value) for value in self.index[row])
+        position              = min(max(position, 0), frames)
+        start, rest           = divmod(position, block)
+        # .item() keeps an int64 index as a Python int, so block = 1 subtracts exactly
+        value                 = self.energy[offset + start].item()
+        if rest:
+            width  = min(block, frames - start * block)
+            value += (self.energy[offset + start + 1].item() - value) * rest / width
+
+        return value
+
+
+    def window_energy (self, row, offset, length):
+        return max(self.cumulative(row, offset + length) - self.cumulative(row, offset), 0)
+
+
+    def window_rms (self, row, offset, length):
+        return np.sqrt(self.window_energy(row, offset, length) / length)
+
+
+    @staticmethod
+    def source_state (path):
+        stat = os.stat(path)
+
+        return [path, stat.st_size, stat.st_mtime_ns]
+
+
+    @classmethod
+    def is_current (cls, index_path, file_list, block = 1):
+        try:
+            with open(os.path.join(index_path, cls.files_name), "r") as f:
+                if json.load(f) != [cls.source_state(path) for path in file_list]:
+                    return False
+            index = np.load(os.path.join(index_path, cls.index_name))
+        except (OSError, ValueError):
+            return False
+
+        return bool(np.all(index[:, 2] == block)) if len(index) else True
+
+
+    @classmethod
+    def open_or_build (cls, file_list, index_path, block = 1, source = None):
+        if not(cls.is_current(index_path, file_list, block)):
+            return cls.build(file_list, index_path, block, source)
+
+        return cls(index_path)
+
+
+    @classmethod
+    def build (cls, file_list, index_path, block = 1, source = None):
+        """
+        file_list : source wav files
+        block     : samples per stored value (1 = exact)
+        source    : sound of row i as source[i] (for example a noise_bank), None reads file_list[i]
+        """
+        if not(os.path.isdir(index_path)):
+            os.makedirs(index_path)
+
+        def read (row):
+            if source is not None:
+                return source[row]
+            if not(file_list[row].lower().endswith(".wav")):
+                _, sound = read_sound(file_list[row])
+                return sound
+            _, sound = scipy.io.wavfile.read(file_list[row], mmap = True)
+
+            return sound
+
+        # 8 and 16 bit sources stay exact in int64, any wider integer or float source makes the whole index float64
+        frames = []
+        dtype  = np.dtype(np.int64)
+        for row in range(len(file_list)):
+            sound = read(row)
+            frames.append(len(sound))
+            if not(np.issubdtype(sound.dtype, np.integer)) or sound.dtype.itemsize > 2:
+                dtype = np.dtype(np.float64)
+            del sound
+
+        frames  = np.asarray(frames, dtype = np.int64)
+        sizes   = -(-frames // block) + 1
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+        index   = np.stack([offsets, frames, np.full(len(frames), block, dtype = np.int64)], axis = 1)
+
+        energy_file = os.path.join(index_path, cls.energy_name + ".tmp")
+        energy      = np.lib.format.open_memmap(energy_file, mode = "w+", dtype = dtype, shape = (int(sizes.sum()), ))
+        for row in tqdm(range(len(file_list))):
+            sound  = np.asarray(read(row)).astype(dtype)
+            square = (sound * sound).reshape(len(sound), -1).sum(axis = 1)
+            if block > 1:
+                square = np.add.reduceat(square, np.arange(0, len(square), block)) if len(square) else square
+            start  = offsets[row]
+            energy[start]                          = 0
+            energy[start + 1 : start + sizes[row]] = np.cumsum(square)
+            del sound, square
+        energy.flush()
+        del energy
+
+        with open(os.path.join(index_path, cls.index_name + ".tmp"), "wb") as f:
+            np.save(f, index)
+        with open(os.path.join(index_path, cls.files_name + ".tmp"), "w") as f:
+            json.dump([cls.source_state(path) for path in file_list], f)
+
+        for name in [cls.index_name, cls.energy_name, cls.files_name]:
+            os.replace(os.path.join(index_path, name + ".tmp"), os.path.join(index_path, name))
+        print("Completed building energy index " + str(index_path))
+
+        return cls(index_path)
+
+
+if __name__ == "__main__":
+    import argparse
+    from discovery import file_index
+
+    parser = argparse.ArgumentParser(description = 'SETTING OPTION')
+    parser.add_argument("--sp",    type = str, default = "./datasets_original/train_noise", help = "Input source path (*.wav)")
+    parser.add_argument("--ip",    type = str, default = "./datasets/energy/noise",         help = "Input energy index path")
+    parser.add_argument("--block", type = int, default = 1,  help = "Input samples per stored value (1 : exact)")
+    args = parser.parse_args()
+
+    file_list = file_index(args.sp, extensions = [".wav"], probe_headers = False).files()
+
+    energy_index.build(file_list, args.ip, block = args.block)
+    print("-- THe END --")
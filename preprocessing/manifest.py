@@ -0,0 +1,178 @@
+import os, glob, json, hashlib, argparse, threading
+
+class run_manifest ():
+    """
+    What a tool has already produced in one output directory.
+        output_dir/.manifest.jsonl : one json line per finished item, appended as soon as the item is written
+
+    record of an item
+        key     : what was produced (source path, example index, shard, ...)
+        sources : [path, size, mtime_ns (, sha1)] of every input of the item
+        params  : hash of the parameters of the run (a changed option invalidates every item)
+        outputs : output files of the item
+        extra   : anything the tool needs to reuse the item (for example the output index)
+
+    def is_done : the item was produced with the same params from unchanged sources and its outputs still exist
+    def record  : append the record of a finished item (thread safe, flushed at once, so a crash loses nothing)
+    def get     : last record of a key (None if missing)
+
+    A crash can leave a broken last line, such a line is ignored and the item is simply produced again.
+
+    A job split over many machines (num_shards > 1) writes one manifest per job shard, .manifest.shard<k>of<n>.jsonl,
+    so no two machines append to the same file. merge_manifests combines them into .manifest.jsonl afterwards.
+    A job shard reads the merged manifest too, so a later run of any shard skips what is already done.
+    """
+    def __init__ (self, output_dir, params, name = ".manifest.jsonl", use_hash = False, num_shards = 1, shard_index = 0):
+        self.output_dir = output_dir
+        self.path       = os.path.join(output_dir, shard_name(name, num_shards, shard_index))
+        self.params     = params_hash(params)
+        self.use_hash   = use_hash
+        self.records    = {}
+        self.lock       = threading.Lock()
+        self.file       = None
+
+        # The merged manifest first, the records of this job shard win
+        self.records.update(read_records(os.path.join(output_dir, name)))
+        if self.path != os.path.join(output_dir, name):
+            self.records.update(read_records(self.path))
+
+
+    def source_state (self, path):
+        stat  = os.stat(path)
+        state = [path, stat.st_size, stat.st_mtime_ns]
+        if self.use_hash:
+            state.append(file_hash(path))
+
+        return state
+
+
+    def get (self, key):
+        return self.records.get(str(key))
+
+
+    def is_done (self, key, sources, outputs):
+        record = self.get(key)
+        if record is None or record["params"] != self.params or record["outputs"] != list(outputs):
+            return False
+
+        if not all(os.path.exists(output) for output in outputs):
+            return False
+
+        try:
+            return record["sources"] == [self.source_state(source) for source in sources]
+        except OSError:
+            return False
+
+
+    def record (self, key, sources, outputs, **extra):
+        record = {"key"     : str(key),
+                  "sources" : [self.source_state(source) for source in sources],
+                  "params"  : self.params,
+                  "outputs" : list(outputs),
+                  "extra"   : extra}
+
+        with self.lock:
+            if self.file is None:
+                if not(os.path.isdir(self.output_dir)):
+                    os.makedirs(self.output_dir)
+                self.file = open(self.path, "a")
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self.records[record["key"]] = record
+
+
+    def close (self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def shard_name (name, num_shards = 1, shard_index = 0):
+    """
+    .manifest.jsonl -> .manifest.shard<k>of<n>.jsonl for job shard k of n (the name itself for one shard)
+    """
+    if num_shards <= 1:
+        return name
+
+    base, extension = os.path.splitext(name)
+
+    return base + ".shard{}of{}".format(shard_index, num_shards) + extension
+
+
+def read_records (path):
+    records = {}
+    if not(os.path.isfile(path)):
+        return records
+
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record["key"]] = record
+
+    return records
+
+
+def merge_manifests (output_dir, name = ".manifest.jsonl"):
+    """
+    Combine the manifests of every job shard in output_dir into one manifest (the last record of a key wins).
+    The shard manifests are kept, so merging again (while a shard is still running) is always safe.
+        return number of records in the merged manifest
+    """
+    base, extension = os.path.splitext(name)
+    paths           = [os.path.join(output_dir, name)] + sorted(glob.glob(os.path.join(output_dir, base + ".shard*of*" + extension)))
+
+    records = {}
+    for path in paths:
+        records.update(read_records(path))
+
+    target = os.path.join(output_dir, name)
+    with open(target + ".tmp", "w") as f:
+        for record in records.values():
+            f.write(json.dumps(record) + "\n")
+    os.replace(target + ".tmp", target)
+    print("Merged " + str(len(paths) - 1) + " shard manifests into " + target + " (" + str(len(records)) + " records)")
+
+    return len(records)
+
+
+def shard_indices (count, num_shards = 1, shard_index = 0):
+    """
+    Global indices of job shard shard_index : every num_shards-th index starting at shard_index.
+    Every machine computes the same partition from the same (naturally ordered) input list,
+    and outputs keep their global index, so the shards never write the same file.
+    """
+    if num_shards < 1 or not(0 <= shard_index < num_shards):
+        raise ValueError("shard_index must be in [0, num_shards), not " + str(shard_index) + " of " + str(num_shards))
+
+    return range(shard_index, count, num_shards)
+
+
+def params_hash (params):
+    """
+    sha1 of the parameters of a run (any json serializable value, dict keys are sorted)
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys = True, default = str).encode("utf-8")).hexdigest()
+
+
+def file_hash (path, chunk_size = 1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda : f.read(chunk_size), b""):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'SETTING OPTION')
+    parser.add_argument("--merge", type = str, nargs = "+", required = True, help = "Input output folders whose shard manifests are merged")
+    parser.add_argument("--name",  type = str, default = ".manifest.jsonl", help = "Input manifest name")
+    args = parser.parse_args()
+
+    for output_dir in args.merge:
+        merge_manifests(output_dir, args.name)
+    print("-- THe END --")
@@ -0,0 +1,221 @@
+"""
+Per stage timers and counters of pcm2wav, resampler, data_mixture and pipeline.
+    with metrics.timer("read") : ...     time a stage (read, decode, resample, crop, mix, write)
+    metrics.count("examples", n)         add to a counter
+
+Nothing is recorded until enable() is called, a disabled timer is one shared no-op context manager.
+Timers can be nested (resample around a read of the next block), the time of an inner timer is
+only counted for the inner stage, so the stage seconds add up to the busy time of the process.
+
+enable(export_path, interval, profile)
+    export_path : folder of the exported files (None only keeps the numbers in memory, see summary)
+    interval    : seconds between two exports while the job runs
+    profile     : also run cProfile, written as profile_<pid>.prof on the last export
+
+Every process writes its own files, so pool workers never share a file
+    export_path/metrics_<pid>.json : {"pid", "time", "stages" : {stage : {calls, seconds, max}}, "counters" : {...}}
+    export_path/metrics_<pid>.prom : the same numbers in the Prometheus textfile format (node_exporter textfile collector)
+Pool workers get the settings through config() / worker_start() in the _worker_init of each module
+and write their last export when the pool is closed and joined.
+"""
+import os, json, time, cProfile, threading
+import multiprocessing.util
+
+PREFIX = "speech_preprocessing"
+
+class stage_metrics ():
+    def __init__ (self):
+        self.enabled     = False
+        self.export_path = None
+        self.interval    = 30.0
+        self.profile     = False
+        self.profiler    = None
+        self.lock        = threading.Lock()
+        self.export_lock = threading.Lock()
+        self.local       = threading.local()
+        self.reset()
+
+
+    def reset (self):
+        self.stages      = {}
+        self.counters    = {}
+        self.last_export = time.time()
+
+
+    def enable (self, export_path = None, interval = 30.0, profile = False):
+        self.enabled     = True
+        self.export_path = export_path
+        self.interval    = interval
+        self.profile     = profile
+        self.reset()
+
+        if self.export_path is not None and not(os.path.isdir(self.export_path)):
+            os.makedirs(self.export_path, exist_ok = True)
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+
+    def config (self):
+        if not(self.enabled):
+            return None
+
+        return {"export_path" : self.export_path, "interval" : self.interval, "profile" : self.profile}
+
+
+    def worker_start (self, config):
+        """
+        Start fresh in a pool worker (a forked worker would otherwise count the numbers of its parent again)
+        """
+        if config is None:
+            self.enabled  = False
+            self.profiler = None
+            return
+
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.enable(**config)
+        # Runs when the worker leaves after pool.close() and pool.join()
+        multiprocessing.util.Finalize(self, self.close, exitpriority = 10)
+
+
+    def timer (self, stage):
+        if not(self.enabled):
+            return _null_timer
+
+        return _stage_timer(self, stage)
+
+
+    def add (self, stage, seconds):
+        with self.lock:
+            calls, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage]    = (calls + 1, total + seconds, max(longest, seconds))
+        self.tick()
+
+
+    def count (self, name, value = 1):
+        if not(self.enabled):
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def tick (self):
+        if self.export_path is not None and time.time() - self.last_export >= self.interval:
+            self.export()
+
+
+    def snapshot (self):
+        with self.lock:
+            return {"pid"      : os.getpid(),
+                    "time"     : time.time(),
+                    "stages"   : {stage : {"calls" : calls, "seconds" : total, "max" : longest}
+                                  for stage, (calls, total, longest) in self.stages.items()},
+                    "counters" : dict(self.counters)}
+
+
+    def export (self):
+        self.last_export = time.time()
+        if self.export_path is None:
+            return
+
+        # Write threads can reach the interval at the same time, they would share the temporary files
+        with self.export_lock:
+            self.write_export()
+
+
+    def write_export (self):
+        snapshot = self.snapshot()
+        pid      = snapshot["pid"]
+        labels   = 'pid="{}"'.format(pid)
+        lines    = []
+        # Every metric is one group of lines after its TYPE line
+        for metric, key in [("stage_seconds_total", "seconds"), ("stage_calls_total", "calls")]:
+            lines.append("# TYPE {}_{} counter".format(PREFIX, metric))
+            for stage, values in sorted(snapshot["stages"].items()):
+                lines.append('{}_{}{{stage="{}",{}}} {}'.format(PREFIX, metric, stage, labels, values[key]))
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("# TYPE {}_{}_total counter".format(PREFIX, name))
+            lines.append("{}_{}_total{{{}}} {}".format(PREFIX, name, labels, value))
+
+        # Written next to the target and renamed, so a reader never sees half a file
+        base = os.path.join(self.export_path, "metrics_{}".format(pid))
+        with open(base + ".json.tmp", "w") as f:
+            json.dump(snapshot, f, indent = 4)
+        os.replace(base + ".json.tmp", base + ".json")
+        with open(base + ".prom.tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(base + ".prom.tmp", base + ".prom")
+
+
+    def close (self):
+        """
+        Last export (and the cProfile dump), then stop recording
+        """
+        if not(self.enabled):
+            return
+
+        self.export()
+        if self.profiler is not None:
+            self.profiler.disable()
+            if self.export_path is not None:
+                self.profiler.dump_stats(os.path.join(self.export_path, "profile_{}.prof".format(os.getpid())))
+            self.profiler = None
+        self.enabled = False
+
+
+    def summary (self):
+        snapshot = self.snapshot()
+        for stage, values in sorted(snapshot["stages"].items(), key = lambda item : -item[1]["seconds"]):
+            print("stage {:>10s} ::: {:8d} calls, {:10.2f} s, {:8.3f} ms/call, max {:8.3f} ms".format(
+                  stage, values["calls"], values["seconds"], 1000 * values["seconds"] / max(values["calls"], 1), 1000 * values["max"]))
+        for name, value in sorted(snapshot["counters"].items()):
+            print("count {:>10s} ::: {}".format(name, value))
+
+
+class _stage_timer ():
+    __slots__ = ("recorder", "stage", "start", "inner")
+
+    def __init__ (self, recorder, stage):
+        self.recorder = recorder
+        self.stage    = stage
+        self.inner    = 0.0
+
+    def __enter__ (self):
+        stack = getattr(self.recorder.local, "stack", None)
+        if stack is None:
+            stack = self.recorder.local.stack = []
+        stack.append(self)
+        self.start = time.perf_counter()
+
+    def __exit__ (self, *exc):
+        seconds = time.perf_counter() - self.start
+        stack   = self.recorder.local.stack
+        stack.pop()
+        if stack:
+            stack[-1].inner += seconds
+        self.recorder.add(self.stage, seconds - self.inner)
+
+
+class _no_timer ():
+    __slots__ = ()
+
+    def __enter__ (self):
+        pass
+
+    def __exit__ (self, *exc):
+        pass
+
+
+_null_timer = _no_timer()
+_recorder   = stage_metrics()
+
+enable       = _recorder.enable
+config       = _recorder.config
+worker_start = _recorder.worker_start
+timer        = _recorder.timer
+count        = _recorder.count
+export       = _recorder.export
+close        = _recorder.close
+summary      = _recorder.summary
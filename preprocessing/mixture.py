@@ -1,4 +1,4 @@
-import os, argparse
+import os, argparse, multiprocessing, collections, itertools
 import wave, natsort
 import numpy as np
 from tqdm import tqdm
@@ -8,6 +8,17 @@ import scipy.signal
 import scipy.io.wavfile
 import librosa
 
+from noise_bank import noise_bank
+from energy import energy_index
+from rir import rir_bank
+from shard import shard_writer
+from wav_io import read_wav_window
+from codec import get_codec, read_sound, extensions as codec_extensions
+from discovery import file_index
+from manifest import run_manifest, params_hash, shard_indices
+from write_behind import write_behind
+import metrics
+
 class data_mixture ():
     """
     Datasets Directory Speech Separation and Enhancement
@@ -22,10 +33,16 @@ class data_mixture ():
 
     def __init__    : Gets the sound source from the test_clean folder and test_noise folder in datasets_source.
     def data_split  : Pick a Speech and cut it to fit the length of the split_length.
+        (data_offset picks the random start point, data_crop cuts and zero pads)
     (The number of replications will soon be determined by the number of data iteration)
     def data_mixing : Mix split clean and noise with Loudness normalize (-25 dBFS) and match the SNR level.
         return noisy, clean
+    def data_mixing_batch : data_mixing for (B, split_length) float32 crops with one SNR per row
+    def data_reverb : Convolve clean crops with room impulse responses (rir.py) before the mixing
     def data_write  : Module for storing sound
+    def make_example : Mix one example with its own seed, return noisy, clean, meta
+    def save_manifest: .manifest.jsonl of the output folder (manifest.py), finished examples or shards are skipped on restart
+    def generate     : Stream (noisy, clean, meta) batches for a training loop without touching disk
 
     def save
         Process
@@ -39,16 +56,33 @@ class data_mixture ():
             Save as .npy in ./datasets/ folder (used as learning data for model)
             Create each sound folder in the ./datasets/ folder.Save as wav file
     """
+    silence_tries = 8
+    rms_floor     = np.float32(1e-8)
+
     def __init__ (self, clean_source_path = "./datasets_original/clean",
                         noise_source_path = "./datasets_original/noise",
                         save_file_path    = "./datasets",
                         noisy_name        = "test_noisy",
                         clean_name        = "test_clean",
-                        SNR               = np.random.randint(0, 5),
+                        SNR               = (0, 5),
                         original_sampling = 16000,
                         target_sampling   = 16000,
                         split_length      = 16384,
-                        iteration         = 1):
+                        iteration         = 1,
+                        seed              = 0,
+                        noise_bank_path   = None,
+                        output_format     = "wav",
+                        shard_size        = 4096,
+                        window_read       = True,
+                        energy_path       = None,
+                        energy_block      = 1,
+                        min_rms           = 0.0,
+                        precision         = "float32",
+                        output_dtype      = "float32",
+                        output_codec      = None,
+                        rir_path          = None,
+                        rir_prob          = 1.0,
+                        clean_extensions  = None):
         '''
         arguments:
             clean_source_path: original clean path
@@ -56,25 +90,34 @@ class data_mixture ():
             save_file_path   : save file path for mixture(noisy) and target(clean)
             noisy_name       : filename of mixture(noisy)
             clean_name       : filenmae of target(clean)
-            SNR              : ratio of signal and noise
+            SNR              : ratio of signal and noise, one value for every example or a (low, high) range,
+                               then every example draws its own SNR = randint(low, high) from its seeded random state
             original_sampling : sampling rate of original sound
             target_sampling   : sampling rate of synthesized sound
             split_length      : cutting size of synthesized sound
             iteration         : iteration of total process
+            seed              : base seed, example index i is mixed with RandomState(seed + i)
+            noise_bank_path   : packed noise bank (noise_bank.py), built from noise_source_path if missing.
+                                None decodes every noise file into memory as before
+            output_format     : "wav" (one noisy and one clean wav per example) or "shard" (shard.py packed arrays)
+            shard_size        : examples per shard for output_format "shard"
+            window_read       : read only the split_length frames of each clean crop (wav_io.py),
+                                the frame counts come from the clean file index (discovery.py) in save_file_path
+            energy_path       : cumulative sum of squares of every clean and noise source (energy.py), built if missing.
+                                The RMS of every crop is then one subtraction, nothing is decoded to measure it
+            energy_block      : samples per stored energy value (1 = exact)
+            min_rms           : crops with a lower RMS (in the sample unit of the source, int16 : 0 ~ 32767) are drawn again,
+                                at most silence_tries times. 0 keeps every crop
+            precision         : dtype of the crops and the mixing, float32 (half the memory traffic) or float64
+            output_dtype      : sample dtype of the written wav files and shards, float32 or int16 (half the size)
+            output_codec      : codec of the written files (codec.py), wav-float32, wav-int16 or flac.
+                                None is the wav codec of output_dtype. Shards always keep output_dtype
+            rir_path          : folder of room impulse responses (rir.py). The clean crops are convolved with a random RIR
+                                before the mixing, so the clean target is the reverberant speech. None keeps the speech dry
+            rir_prob          : probability of a reverberant example
+            clean_extensions  : file extensions of the clean sources, None keeps the extensions of the codecs (codec.py).
+                                pipeline.py passes [".pcm"] for raw pcm input
         '''
-        def walk_filename (file_path):
-            file_list = []
-
-            for root, dirs, files in tqdm(os.walk(file_path)):
-                for fname in files:
-                    if fname == "desktop.ini" or fname == ".DS_Store":
-                        continue 
-                    full_fname = os.path.join(root, fname)
-                    file_list.append(full_fname)
-            file_list = natsort.natsorted(file_list, reverse = False)
-            
-            return file_list
-
         def folder_make(folder_path):
             if not(os.path.isdir(folder_path)):
                 os.makedirs(folder_path)
@@ -87,36 +130,99 @@ class data_mixture ():
         self.noisy_name        = noisy_name
         self.clean_name        = clean_name
 
-        self.SNR = SNR
+        self.SNR = tuple(SNR) if isinstance(SNR, (tuple, list)) else SNR
         self.original_sampling = original_sampling
         self.target_sampling   = target_sampling
         self.split_length      = split_length
         self.iteration         = iteration
-
-        self.clean_file_list   = walk_filename(self.clean_source_path)
-        self.noise_file_list   = walk_filename(self.noise_source_path)
+        self.seed              = seed
+        self.noise_bank_path   = noise_bank_path
+        self.output_format     = output_format
+        self.shard_size        = shard_size
+        self.window_read       = window_read
+        self.energy_path       = energy_path
+        self.energy_block      = energy_block
+        self.min_rms           = min_rms
+        self.precision         = np.dtype(precision)
+        self.output_dtype      = output_dtype
+        self.output_codec      = output_codec if output_codec is not None else "wav-" + output_dtype
+        self.rir_path          = rir_path
+        self.rir_prob          = rir_prob
+        self.clean_extensions  = codec_extensions() if clean_extensions is None else clean_extensions
+
+        if self.output_format not in ["wav", "shard"]:
+            raise ValueError("output_format must be wav or shard, not " + str(self.output_format))
+        if self.precision not in [np.float32, np.float64]:
+            raise ValueError("precision must be float32 or float64, not " + str(precision))
+        if self.output_dtype not in ["float32", "int16"]:
+            raise ValueError("output_dtype must be float32 or int16, not " + str(self.output_dtype))
+        self.codec             = get_codec(self.output_codec)
+
+        # Cached, naturally ordered file lists (discovery.py), a second run only rescans changed folders
+        self.clean_index       = file_index(self.clean_source_path, index_path = self.save_file_path + "/.clean_index.json",
+                                            extensions = self.clean_extensions, probe_headers = self.window_read)
+        self.noise_index       = file_index(self.noise_source_path, index_path = self.save_file_path + "/.noise_index.json",
+                                            extensions = codec_extensions(), probe_headers = False)
+        self.clean_file_list   = self.clean_index.files()
+        self.noise_file_list   = self.noise_index.files()
 
         self.noisy_file_path   = self.save_file_path + "/" + self.noisy_name + "/"
         self.clean_file_path   = self.save_file_path + "/" + self.clean_name + "/"
-        folder_make(self.noisy_file_path)
-        folder_make(self.clean_file_path)
+        self.shard_file_path   = self.save_file_path + "/" + self.noisy_name + "_shards/"
+        if self.output_format == "wav":
+            folder_make(self.noisy_file_path)
+            folder_make(self.clean_file_path)
 
 
         'Load noise_source_sound, clean_source_file'
         self.noise_source = []
         self.clean_source = []
 
-        for _, data in tqdm(enumerate(self.noise_file_list)):
-            sr, sound = scipy.io.wavfile.read(data)
-            self.noise_source.append(sound)
-        print("Completed loading of noise source memory")
+        if self.noise_bank_path is not None:
+            # Memory mapped noise, self.noise_source[i] is a zero copy view
+            # A bank of other or changed noise files is built again, the noise ids must match noise_file_list
+            if not(noise_bank.is_current(self.noise_bank_path, self.noise_file_list)):
+                noise_bank.build(self.noise_file_list, self.noise_bank_path)
+            self.noise_source = noise_bank(self.noise_bank_path)
+            print("Completed mapping of noise bank " + str(self.noise_bank_path))
+
+        else:
+            for _, data in tqdm(enumerate(self.noise_file_list)):
+                sr, sound = read_sound(data)
+                self.noise_source.append(sound)
+            print("Completed loading of noise source memory")
 
         for iteration in range(self.iteration):
             self.clean_source.extend(self.clean_file_list)
+        # Clean source of an example whose index is not its position in clean_source (set by save, see assign_indices)
+        self.example_paths = {}
         print("Completed loading voice source iteration list")
 
-
-    def data_split (self, clean_speech):
+        self.clean_headers = {}
+        if self.window_read:
+            self.clean_headers = self.clean_index.headers()
+
+        self.clean_energy = None
+        self.noise_energy = None
+        if self.energy_path is not None:
+            self.clean_energy = energy_index.open_or_build(self.clean_file_list, self.energy_path + "/clean", self.energy_block)
+            # Row i of the index must be noise i of noise_source, a bank keeps the file list it was built from
+            noise_files       = self.noise_source.file_list if isinstance(self.noise_source, noise_bank) else self.noise_file_list
+            if len(noise_files) != len(self.noise_source):
+                raise ValueError("the noise source has " + str(len(self.noise_source)) + " sounds but " + str(len(noise_files)) + " files")
+            self.noise_energy = energy_index.open_or_build(noise_files, self.energy_path + "/noise", self.energy_block,
+                                                           source = self.noise_source)
+            print("Completed mapping of energy index " + str(self.energy_path))
+
+        self.rir = None
+        if self.rir_path is not None:
+            self.rir_index = file_index(self.rir_path, index_path = self.save_file_path + "/.rir_index.json",
+                                        extensions = codec_extensions(), probe_headers = False)
+            self.rir       = rir_bank(self.rir_index.files(), self.target_sampling)
+            print("Completed loading of " + str(len(self.rir)) + " room impulse responses")
+
+
+    def data_split (self, clean_speech, rng = np.random):
         """
         Cut as much as you want from the voice file.
         (sr = 16000 and 48,000 slices 3sec)
@@ -128,22 +234,146 @@ class data_mixture ():
         If you subtract the desired split lance 16000 here, the index is [47999-16000] = [31999]
         Clean = Clean [31999 : 4799] This principle
         """
-        if len(clean_speech) <= self.split_length:
-            # Because clean_spech is shorter than split_length, the extra length to split_length is zero padding
-            zero_padding = [0 for i in range(len(clean_speech), self.split_length)]
-            # convert the split voice and the rest of the zero padding
-            result       = np.concatenate([clean_speech, zero_padding])
+        return self.data_crop(clean_speech, self.data_offset(len(clean_speech), rng))
+
+
+    def data_snr (self, rng = np.random):
+        """
+        SNR of one example, drawn from rng if self.SNR is a (low, high) range
+        """
+        if isinstance(self.SNR, tuple):
+            return rng.randint(*self.SNR)
+
+        return self.SNR
+
+
+    def data_offset (self, length, rng = np.random):
+        """
+        Random start point of a split_length crop in a sound of "length" samples (0 if it is not longer)
+        """
+        if length <= self.split_length:
+            return 0
+
+        return rng.randint(length - self.split_length)
+
+
+    def data_offset_active (self, length, rng, window_rms):
+        """
+        data_offset, drawn again while window_rms(offset) is below min_rms (at most silence_tries draws).
+        With min_rms = 0 this is exactly data_offset, so the random stream does not change.
+        """
+        offset = self.data_offset(length, rng)
+        if self.min_rms <= 0 or length <= self.split_length:
+            return offset
+
+        for _ in range(self.silence_tries - 1):
+            if window_rms(offset) >= self.min_rms:
+                break
+            offset = self.data_offset(length, rng)
+
+        return offset
+
+
+    def sound_rms (self, sound, offset):
+        """
+        RMS of sound[offset : offset + split_length] zero padded to split_length (the crop of data_crop)
+        """
+        crop = np.asarray(sound[offset : offset + self.split_length], dtype = np.float64)
+
+        return np.sqrt(np.dot(crop, crop) / self.split_length)
+
+
+    def data_crop (self, sound, offset, out = None):
+        """
+        sound[offset : offset + split_length] in a buffer of the precision dtype, zero padded at the end if the sound is shorter
+        out : preallocated split_length buffer to fill (for example a row of a batch), a new one if None
+        """
+        result = np.zeros(self.split_length, dtype = self.precision) if out is None else out
+        crop   = sound[offset : offset + self.split_length]
+        # Because the sound can be shorter than split_length, the extra length to split_length stays zero padding
+        result[:len(crop)] = crop
+        if out is not None:
+            result[len(crop):] = 0
+
+        return result
+
+
+    @staticmethod
+    def row_energy (batch):
+        """
+        Sum of squares of every row. The same value for a row in any batch (einsum sums a single row
+        in another order), so a job shard or a smaller last batch mixes exactly the same example.
+        """
+        return np.square(batch).sum(axis = 1)
 
-            return result
 
-        elif len(clean_speech) > self.split_length:
-            random_point = np.random.randint(len(clean_speech) - self.split_length)
-            result       = clean_speech[random_point : random_point + self.split_length]
+    def data_mixing_batch (self, clean, noise, SNR = None, rms_clean = None, rms_noise = None, inplace = False):
+        """
+        Mix B clean crops with B noise crops at once.
+        clean, noise : float32 arrays of shape (B, split_length), already cut by data_split
+        SNR          : one value or B values (one per row), data_snr() if None
+        rms_clean, rms_noise : B RMS values already known (energy index), computed from the crops if None
+        inplace      : scale clean and noise in their own buffers (no temporary arrays),
+                       then clean holds the clean result and noise the noisy result
+
+        Each row is loudness normalized (-25 dBFS) and the noise is scaled to the SNR level,
+        the same as data_mixing but with a handful of array operations for the whole batch.
+            return noisy, clean (B, split_length) float32
+        """
+        if SNR is None:
+            SNR = self.data_snr()
+        SNR    = np.broadcast_to(np.asarray(SNR, dtype = np.float32), (len(clean), ))
+        length = np.float32(clean.shape[1])
+
+        if rms_clean is None:
+            rms_clean = np.sqrt(self.row_energy(clean) / length)
+        if rms_noise is None:
+            rms_noise = np.sqrt(self.row_energy(noise) / length)
+        # A silent crop would divide by zero and give a NaN mixture
+        rms_clean = np.maximum(np.broadcast_to(np.asarray(rms_clean, dtype = np.float32), (len(clean), )), self.rms_floor)
+        rms_noise = np.maximum(np.broadcast_to(np.asarray(rms_noise, dtype = np.float32), (len(clean), )), self.rms_floor)
+
+        # Normalize sound, then calculate the scale of noise to create the desired SNR
+        level        = np.float32(10 ** (-25 / 20))
+        scalar_clean = level / rms_clean
+        scalar_noise = level / rms_noise
+        noise_scalar = np.sqrt(rms_clean / rms_noise / (10 ** (SNR / 20)))
+
+        if inplace:
+            clean       *= scalar_clean[:, None]
+            noise       *= (scalar_noise * noise_scalar)[:, None]
+            noise       += clean
+            clean_result = clean
+            noisy_result = noise
+        else:
+            clean_result = clean * scalar_clean[:, None]
+            noisy_result = clean_result + noise * (scalar_noise * noise_scalar)[:, None]
 
-            return result
+        return noisy_result, clean_result
 
 
-    def data_mixing (self, clean, noise):
+    def data_reverb (self, clean, rir_ids, rms_clean = None):
+        """
+        Convolve the clean crops (B, split_length) with their room impulse response in place,
+        one batched FFT convolution for all rows (rir.py). Rows with rir_id None stay dry.
+        rms_clean : RMS of the dry crops if already known, the convolved rows are measured again
+            return rms_clean of the result (None if it was None)
+        """
+        rows = [row for row, rir_id in enumerate(rir_ids) if rir_id is not None]
+        if not rows:
+            return rms_clean
+
+        with metrics.timer("reverb"):
+            self.rir.convolve(clean, rows, [rir_ids[row] for row in rows])
+        if rms_clean is not None:
+            wet             = clean[rows]
+            rms_clean       = np.array(rms_clean, dtype = np.float64)
+            rms_clean[rows] = np.sqrt(self.row_energy(wet) / clean.shape[1])
+
+        return rms_clean
+
+
+    def data_mixing (self, clean, noise, rng = np.random):
         '''
         argments
             clean = scipy.io.wavfile.read(One of the list of voice files)
@@ -166,74 +396,448 @@ class data_mixture ():
             scipy.io.wavfile.write(noisy path)
             scipy.io.wavfile.write(noisy path)
             scipy.io.wavfile.write(noisy path)
+
+        A single example version of data_mixing_batch.
+        If the noise is shorter than split_length it is zero padded, otherwise a random part is cut.
         '''
+        noise_split                = self.data_split(noise, rng)
+        noisy_result, clean_result = self.data_mixing_batch(clean[None, :], noise_split[None, :], self.data_snr(rng))
 
-        def SNR_calcaulator (SNR, clean, noise):
-            """
-            Calculate the scale of noise to create the desired SNR
-            Make noisy voice using this alpha value.
-            """
-            rms_clean = np.sqrt((np.dot(clean, clean) / len(clean)))
-            rms_noise = np.sqrt((np.dot(noise, noise) / len(noise)))
-            
-            # Normalize sound
-            scalar_clean = 10 ** (-25 / 20) / rms_clean
-            scalar_noise = 10 ** (-25 / 20) / rms_noise
-            clean        = clean * scalar_clean
-            noise        = noise * scalar_noise
-            noise_scalar = np.sqrt((rms_clean / rms_noise / (10**(SNR/20))))
-            noisy        = clean + (noise_scalar * noise)
-
-            return noisy, clean
-
-        # Randomly SNR
-        SNR = self.SNR
-
-        if len(noise) <= self.split_length:
-            """
-            If the noise length chosen randomly is short, then the self.split_length,
-            Bring all the length and add zero padding.
-            They don't index again because they have to add to their voice even if they have zero padding anyway.
-            """
-            zero_padding               = [0 for i in range(len(noise), self.split_length)]
-            noise_split                = np.concatenate([noise, zero_padding])
-            noisy_result, clean_result = SNR_calcaulator(SNR, clean, noise_split)
-
-        elif len(noise) > self.split_length:
-            noise_point                = np.random.randint(len(noise) - self.split_length)
-            noise_split                = noise[noise_point : noise_point + self.split_length]
-            noisy_result, clean_result = SNR_calcaulator(SNR, clean, noise_split)
+        return noisy_result[0], clean_result[0]
 
-        return noisy_result, clean_result
-    
 
     def data_write (self, file_path, sound, index):
-        scipy.io.wavfile.write(file_path + "{:08d}".format(index+1) + ".wav", rate = self.target_sampling,  data = sound)
+        with metrics.timer("write"):
+            # The samples are converted and encoded here, on the write thread or the worker process
+            self.codec.write(self.output_file(file_path, index), sound, self.target_sampling)
+
+
+    def output_file (self, file_path, index):
+        return file_path + "{:08d}".format(index+1) + self.codec.extension
     
 
-    def save (self, subset_length):
+    def source_path (self, index):
+        """
+        Clean source of example "index"
+        """
+        path = self.example_paths.get(index)
+
+        return self.clean_source[index] if path is None else path
+
+
+    def assign_indices (self, manifest):
+        """
+        Example index of every position in self.clean_source (the same rule as resampler.assign_indices).
+        An example is (clean path, repeat), repeat counts the earlier copies of the path (iteration > 1).
+        A recorded example keeps its recorded index (so its name and seed), any other one takes its position,
+        unless a recorded example already uses that index, then it gets the next index after all used ones.
+        A clean file added in the middle of the folder therefore never renames or remixes the examples after it.
+            return list of (index, clean path, repeat)
+        """
+        recorded = {}
+        for record in manifest.records.values():
+            if record["sources"] and str(record["key"]).isdigit():
+                recorded[(record["sources"][0][0], record["extra"].get("repeat", 0))] = int(record["key"])
+
+        repeats    = collections.Counter()
+        examples   = []
+        for path in self.clean_source:
+            examples.append((path, repeats[path]))
+            repeats[path] += 1
+
+        present    = set(examples)
+        recorded   = {example : index for example, index in recorded.items() if example in present}
+        used       = set(recorded.values())
+        next_index = max(list(used) + [len(examples) - 1]) + 1
+        items      = []
+
+        for position, example in enumerate(examples):
+            if example in recorded:
+                index = recorded[example]
+            elif position not in used:
+                index = position
+            else:
+                index       = next_index
+                next_index += 1
+            used.add(index)
+            items.append((index, ) + example)
+
+        return items
+
+
+    def make_crops (self, index, seed = None, sound = None, clean_out = None, noise_out = None):
+        """
+        Read the clean source of global index "index" and cut the clean and noise crops for it.
+        Every random choice comes from RandomState(seed + index) (seed is self.seed if None),
+        so the result does not depend on which process handles the example.
+        sound : the clean source already decoded in memory (pipeline.py), then no file is read
+        clean_out, noise_out : preallocated buffers of the crops (data_crop)
+            return split_clean, split_noise (split_length float32), meta (SNR, clean source, noise id and offsets)
+        """
+        rng          = np.random.RandomState((self.seed if seed is None else seed) + index)
+        clean_path   = self.source_path(index)
+        header       = self.clean_headers.get(clean_path)
+
+        # The energy index describes the files on disk, not a sound passed in memory
+        clean_energy = self.clean_energy if sound is None else None
+        clean_row    = None if clean_energy is None else clean_energy.row(clean_path)
+        read_window  = lambda offset : read_wav_window(clean_path, offset, self.split_length, header)
+
+        if sound is not None:
+            clean_offset = self.data_offset_active(len(sound), rng, lambda offset : self.sound_rms(sound, offset))
+            crop_offset  = clean_offset
+
+        elif header is not None and header["dtype"] is not None:
+            # Only the header is known here, seek and read just the split_length frames of the crop
+            if clean_energy is not None:
+                clean_rms = lambda offset : clean_energy.window_rms(clean_row, offset, self.split_length)
+            else:
+                clean_rms = lambda offset : self.sound_rms(read_window(offset), 0)
+            clean_offset = self.data_offset_active(header["frames"], rng, clean_rms)
+            crop_offset  = 0
+            with metrics.timer("read"):
+                sound    = read_window(clean_offset)
+
+        else:
+            with metrics.timer("read"):
+                _, sound = read_sound(clean_path)
+            if clean_energy is not None:
+                clean_rms = lambda offset : clean_energy.window_rms(clean_row, offset, self.split_length)
+            else:
+                clean_rms = lambda offset : self.sound_rms(sound, offset)
+            clean_offset = self.data_offset_active(len(sound), rng, clean_rms)
+            crop_offset  = clean_offset
+
+        noise_index  = rng.randint(len(self.noise_source))
+        noise        = self.noise_source[noise_index]
+        if self.noise_energy is not None:
+            noise_rms = lambda offset : self.noise_energy.window_rms(noise_index, offset, self.split_length)
+        else:
+            noise_rms = lambda offset : self.sound_rms(noise, offset)
+        noise_offset = self.data_offset_active(len(noise), rng, noise_rms)
+
+        SNR          = self.data_snr(rng)
+
+        # Drawn last, so the crops, the noise and the SNR are the same with and without RIRs
+        rir_id       = None
+        if self.rir is not None:
+            reverb = rng.random_sample() < self.rir_prob
+            rir_id = rng.randint(len(self.rir))
+            rir_id = rir_id if reverb else None
+
+        # A noise bank is memory mapped, so its pages are read here
+        with metrics.timer("crop"):
+            split_clean = self.data_crop(sound, crop_offset, clean_out)
+            split_noise = self.data_crop(noise, noise_offset, noise_out)
+
+        meta         = {"snr"          : float(SNR),
+                        "clean_path"   : clean_path,
+                        "clean_offset" : int(clean_offset),
+                        "noise_id"     : int(noise_index),
+                        "noise_offset" : int(noise_offset)}
+        if clean_energy is not None:
+            meta["clean_rms"] = float(clean_rms(clean_offset))
+        if self.noise_energy is not None:
+            meta["noise_rms"] = float(noise_rms(noise_offset))
+        if self.rir is not None:
+            meta["rir_id"]    = None if rir_id is None else int(rir_id)
+
+        return split_clean, split_noise, meta
+
+
+    def make_example (self, index, seed = None, sound = None):
+        """
+        Mix the example of global index "index".
+            return noisy, clean (split_length float32), meta
+        """
+        split_clean, split_noise, meta = self.make_crops(index, seed, sound)
+        rms_clean                      = meta.get("clean_rms")
+        if meta.get("rir_id") is not None:
+            rms_clean = self.data_reverb(split_clean[None, :], [meta["rir_id"]], None if rms_clean is None else [rms_clean])
+        with metrics.timer("mix"):
+            noisy, clean               = self.data_mixing_batch(split_clean[None, :], split_noise[None, :], meta["snr"],
+                                                                rms_clean = rms_clean,
+                                                                rms_noise = meta.get("noise_rms"),
+                                                                inplace   = True)
+        metrics.count("examples")
+
+        return noisy[0], clean[0], meta
+
+
+    def make_batch (self, indices, seed = None):
+        """
+        Mix a batch of examples with one data_mixing_batch call.
+            return noisy, clean (B, split_length float32), list of B meta
+        """
+        split_clean = np.empty((len(indices), self.split_length), dtype = self.precision)
+        split_noise = np.empty((len(indices), self.split_length), dtype = self.precision)
+        metas       = []
+
+        # The crops are cut straight into the rows of the batch
+        for row, index in enumerate(indices):
+            _, _, meta = self.make_crops(index, seed, clean_out = split_clean[row], noise_out = split_noise[row])
+            metas.append(dict(meta, index = int(index)))
+
+        rms_clean = None
+        rms_noise = None
+        if all("clean_rms" in meta for meta in metas):
+            rms_clean = np.array([meta["clean_rms"] for meta in metas])
+        if all("noise_rms" in meta for meta in metas):
+            rms_noise = np.array([meta["noise_rms"] for meta in metas])
+        if self.rir is not None:
+            rms_clean = self.data_reverb(split_clean, [meta["rir_id"] for meta in metas], rms_clean)
+
+        with metrics.timer("mix"):
+            noisy, clean = self.data_mixing_batch(split_clean, split_noise, [meta["snr"] for meta in metas],
+                                                  rms_clean = rms_clean, rms_noise = rms_noise, inplace = True)
+        metrics.count("examples", len(indices))
+
+        return noisy, clean, metas
+
+
+    def generate (self, batch_size = 32, epochs = 1, workers = 0, prefetch = 4, shuffle = True):
+        """
+        Stream (noisy, clean, meta) batches without writing anything to disk.
+            noisy, clean : (B, split_length) float32
+            meta         : list of B dict (index, SNR, clean source, noise id and offsets)
+
+        batch_size : examples per batch (the last batch of an epoch may be smaller)
+        epochs     : number of passes over the clean source, None streams forever
+        workers    : background mixing processes, 0 mixes in the calling process
+        prefetch   : batches mixed ahead of the consumer (bounded, so memory stays fixed)
+        shuffle    : visit the clean source in a new order every epoch
+
+        Epoch e uses the seed (self.seed + e * len(clean_source)), so every epoch gets new crops,
+        noise and order, and the stream is the same for any number of workers.
+        """
+        def batches ():
+            for epoch in (itertools.count() if epochs is None else range(epochs)):
+                seed  = self.seed + epoch * len(self.clean_source)
+                order = np.arange(len(self.clean_source))
+                if shuffle:
+                    np.random.RandomState(seed).shuffle(order)
+
+                for start in range(0, len(order), batch_size):
+                    yield order[start : start + batch_size], seed
+
+        if workers <= 0:
+            for indices, seed in batches():
+                yield self.make_batch(indices, seed)
+
+            return
+
+        with multiprocessing.Pool(workers, initializer = _worker_init, initargs = (self, metrics.config())) as pool:
+            pending = collections.deque()
+
+            for indices, seed in batches():
+                pending.append(pool.apply_async(_worker_make_batch, (indices, seed)))
+                if len(pending) >= max(prefetch, 1):
+                    yield pending.popleft().get()
+
+            while pending:
+                yield pending.popleft().get()
+
+            # Let the workers exit on their own, so their metrics are exported (leaving "with" terminates them)
+            pool.close()
+            pool.join()
+
+
+    def save_example (self, index):
+        """
+        Mix and write the example of global index "index" as two wav files
+        """
+        noisy, clean, _ = self.make_example(index)
+        # noise = noisy - clean
+
+        self.write_example(index, noisy, clean)
+
+
+    def save_batch (self, indices):
+        """
+        Mix the examples of "indices" with one make_batch call (one batched RIR convolution) and write them
+        """
+        noisy, clean, _ = self.make_batch(indices)
+        for row, index in enumerate(indices):
+            self.write_example(index, noisy[row], clean[row])
+
+
+    def write_example (self, index, noisy, clean):
+        self.data_write(self.noisy_file_path, noisy, index = index)
+        self.data_write(self.clean_file_path, clean, index = index)
+        # self.data_write(self.save_file_path + "/noise/", noise, index)
+
+
+    def save_manifest (self, output_dir, use_hash = False, num_shards = 1, shard_index = 0):
+        """
+        Manifest of the output folder. Everything that changes the mixed sound is in the parameters,
+        the noise files by path, size and mtime (the chosen noise id depends on the whole list).
+        Job shard shard_index of num_shards writes its own manifest (manifest.merge_manifests combines them).
+        """
+        noise_state = [[path, os.path.getsize(path), os.path.getmtime(path)] for path in self.noise_file_list]
+        rir_state   = [] if self.rir is None else [[path, os.path.getsize(path), os.path.getmtime(path)] for path in self.rir.file_list]
+        # The SNR mode (a value or a range) is hashed, the drawn values follow from the seed
+        params      = {"SNR"             : self.SNR,
+                       "target_sampling" : self.target_sampling,
+                       "split_length"    : self.split_length,
+                       "seed"            : self.seed,
+                       "min_rms"         : self.min_rms,
+                       "energy"          : None if self.energy_path is None else {"block" : self.energy_block},
+                       "precision"       : self.precision.name,
+                       "output_dtype"    : self.output_dtype,
+                       "codec"           : self.output_codec,
+                       "rir"             : None if self.rir is None else params_hash(rir_state),
+                       "rir_prob"        : self.rir_prob,
+                       "noise"           : params_hash(noise_state)}
+
+        return run_manifest(output_dir, params, use_hash = use_hash, num_shards = num_shards, shard_index = shard_index)
+
+
+    def save (self, subset_length, workers = 1, use_hash = False, write_workers = 2, write_depth = 64,
+                    num_shards = 1, shard_index = 0, batch_size = 32):
+        """
+        workers       : mixing processes (each worker writes its own examples)
+        batch_size    : examples mixed together by make_batch (one batched RIR convolution), the result of an example
+                        does not depend on the batch it is mixed in
+        write_workers : with workers = 1, threads that encode and write the output files while the next examples are mixed
+                        (write_behind.py), 0 writes synchronously. With more workers every process encodes its own examples
+        write_depth   : examples mixed ahead of the writes at most (bounded memory)
+        num_shards    : split the job over num_shards machines, this run mixes job shard shard_index
+                        (every num_shards-th example, manifest.shard_indices). Names and seeds stay those of the
+                        global example index (the SNR of a range is drawn from that seed too, see data_snr),
+                        so the union of all job shards is the output of one unsplit run for every --snr mode.
+        """
         if subset_length is None:
           pass
         else:
           self.clean_source = self.clean_source[:subset_length]
-          
-        for index, data in tqdm(enumerate(self.clean_source)):
-            _, sound     = scipy.io.wavfile.read(data)
-            split_clean  = self.data_split(sound)
-            noise_index  = np.random.randint(len(self.noise_source))
-            noisy, clean = self.data_mixing(split_clean, self.noise_source[noise_index])
-            
-            noisy = noisy.astype("float32")
-            clean = clean.astype("float32")
-            # noise = noisy - clean
-
-            self.data_write(self.noisy_file_path, noisy, index = index)
-            self.data_write(self.clean_file_path, clean, index = index)
-            # self.data_write(self.save_file_path + "/noise/", noise, index)
+
+        if num_shards > 1:
+            print("Job shard " + str(shard_index) + " of " + str(num_shards))
+
+        if self.output_format == "shard":
+            self.save_shard(workers, use_hash, num_shards, shard_index, batch_size)
+            print("Complete dataset production using sound source")
+
+            return
+
+        # Example "index" is done if it was mixed with the same parameters from the same, unchanged clean file
+        manifest = self.save_manifest(self.noisy_file_path, use_hash, num_shards, shard_index)
+        outputs  = lambda index : [self.output_file(self.noisy_file_path, index), self.output_file(self.clean_file_path, index)]
+        items    = self.assign_indices(manifest)
+        items    = [items[position] for position in shard_indices(len(items), num_shards, shard_index)]
+        repeats  = {index : repeat for index, _, repeat in items}
+        self.example_paths = {index : path for index, path, _ in items}
+        todo     = [index for index, path, _ in items if not manifest.is_done(index, [path], outputs(index))]
+        print(str(len(items) - len(todo)) + " examples already done, " + str(len(todo)) + " examples to mix")
+
+        def record (index):
+            manifest.record(index, [self.source_path(index)], outputs(index), repeat = repeats[index])
+
+        def write (index, noisy, clean):
+            # Recorded only after both files are written
+            self.write_example(index, noisy, clean)
+            record(index)
+
+        batches = [todo[start : start + max(batch_size, 1)] for start in range(0, len(todo), max(batch_size, 1))]
+        if workers <= 1:
+            with write_behind(workers = write_workers, depth = write_depth) as writer, tqdm(total = len(todo)) as progress:
+                for indices in batches:
+                    noisy, clean, _ = self.make_batch(indices)
+                    for row, index in enumerate(indices):
+                        writer.submit(write, index, noisy[row], clean[row])
+                    progress.update(len(indices))
+
+        else:
+            # Workers inherit this object (noise_source included) once, then only indices are sent
+            with multiprocessing.Pool(workers, initializer = _worker_init, initargs = (self, metrics.config())) as pool, \
+                 tqdm(total = len(todo)) as progress:
+                for indices in pool.imap_unordered(_worker_save_batch, batches):
+                    for index in indices:
+                        record(index)
+                    progress.update(len(indices))
+                pool.close()
+                pool.join()
+
+        manifest.close()
+        self.example_paths = {}
 
         print("Complete dataset production using sound source")
 
 
+    def save_shard (self, workers = 1, use_hash = False, num_shards = 1, shard_index = 0, batch_size = 32):
+        """
+        Write every example into fixed size shards (shard.py) instead of wav files.
+        Examples come back in index order, so each shard is filled and written once.
+        A shard recorded in the manifest with unchanged clean sources is not mixed again.
+        A job shard takes whole data shards (every num_shards-th one), so no shard file is written by two machines.
+        Rows are the positions in clean_source (a shard is one contiguous block), so unlike the wav output a clean file
+        added in the middle of the folder moves the examples after it and their shards are mixed again.
+        """
+        manifest = self.save_manifest(self.shard_file_path, use_hash, num_shards, shard_index)
+        total    = len(self.clean_source)
+        owned    = shard_indices(-(-total // self.shard_size), num_shards, shard_index)
+        sources  = lambda data_shard : self.clean_source[data_shard * self.shard_size : (data_shard + 1) * self.shard_size]
+
+        def record (data_shard, meta):
+            manifest.record("shard:" + str(data_shard), sources(data_shard), writer.files(data_shard))
+
+        writer  = shard_writer(self.shard_file_path, self.split_length, shard_size = self.shard_size,
+                               dtype = self.output_dtype, sampling_rate = self.target_sampling, on_flush = record)
+        shards  = [data_shard for data_shard in owned
+                   if not manifest.is_done("shard:" + str(data_shard), sources(data_shard), writer.files(data_shard))]
+        indices = [index for data_shard in shards
+                   for index in range(data_shard * self.shard_size, min((data_shard + 1) * self.shard_size, total))]
+        print(str(len(owned) - len(shards)) + " shards already done, " + str(len(shards)) + " shards to mix")
+
+        batches = [indices[start : start + max(batch_size, 1)] for start in range(0, len(indices), max(batch_size, 1))]
+
+        def append (batch, mixed):
+            for row, (index, meta) in enumerate(zip(batch, mixed[2])):
+                writer.append(index, mixed[0][row], mixed[1][row], meta)
+
+        if workers <= 1:
+            for batch in tqdm(batches):
+                append(batch, self.make_batch(batch))
+
+        else:
+            with multiprocessing.Pool(workers, initializer = _worker_init, initargs = (self, metrics.config())) as pool:
+                for batch, mixed in tqdm(zip(batches, pool.imap(_worker_make_batch, batches)), total = len(batches)):
+                    append(batch, mixed)
+                pool.close()
+                pool.join()
+
+        writer.close(count = total)
+        manifest.close()
+
+
+def snr_mode (snr):
+    """
+    --snr of the scripts to the SNR argument of data_mixture
+        0 : 0 ~ 5, 1 : -2 ~ 3, 2 : -5 ~ 0 (randint range, drawn per example), -1 : 0, any other value : that SNR
+    """
+    modes = {0 : (0, 5), 1 : (-2, 3), 2 : (-5, 0), -1 : 0}
+
+    return modes.get(snr, snr)
+
+
+_worker_factory = None
+
+def _worker_init (factory, metrics_config = None):
+    global _worker_factory
+    _worker_factory = factory
+    metrics.worker_start(metrics_config)
+
+
+def _worker_save_batch (indices):
+    _worker_factory.save_batch(indices)
+
+    return indices
+
+
+def _worker_make_batch (indices, seed = None):
+    return _worker_factory.make_batch(indices, seed)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description = 'SETTING OPTION')
@@ -242,12 +846,35 @@ if __name__ == "__main__":
     parser.add_argument("--sp", type = str, default = "./datasets/short",    help = "Input save path")
     parser.add_argument("--nn", type = str, default = "train_noisy",   help = "Input noisy name")
     parser.add_argument("--cn", type = str, default = "train_clean",   help = "Input clean name")
-    parser.add_argument("--snr",    type = int, default = 0,      help = "0 : 0 ~ 5, 1 : -2 ~ 3, 2 : -5 ~ 0")
+    parser.add_argument("--snr",    type = int, default = 0,      help = "0 : 0 ~ 5, 1 : -2 ~ 3, 2 : -5 ~ 0 (drawn per example from the seed), -1 : 0")
     parser.add_argument("--os",     type = int, default = 16000,  help = "Input original sampling")
     parser.add_argument("--ts",     type = int, default = 16000,  help = "Input target sampling")
     parser.add_argument("--length", type = int, default = 16384,  help = "Input split length")
     parser.add_argument("--itera",  type = int, default = 1,      help = "Input iteration")
     parser.add_argument("--sub",    type = int, default = 100000, help = "Input sub slice")
+    parser.add_argument("--seed",    type = int, default = 0, help = "Input base seed (example i uses seed + i)")
+    parser.add_argument("--workers", type = int, default = 1, help = "Input number of mixing processes")
+    parser.add_argument("--batch",   type = int, default = 32, help = "Input examples mixed per batch")
+    parser.add_argument("--nb",      type = str, default = None, help = "Input noise bank path (built on first use)")
+    parser.add_argument("--format",     type = str, default = "wav", help = "Input output format wav or shard")
+    parser.add_argument("--shard_size", type = int, default = 4096,  help = "Input examples per shard")
+    parser.add_argument("--window",     type = int, default = 1,     help = "Input 1 : read only the crop of each clean file, 0 : decode whole files")
+    parser.add_argument("--hash",       type = int, default = 0,     help = "Input 1 : detect changed clean files by sha1 instead of size and mtime")
+    parser.add_argument("--energy",           type = str,   default = None, help = "Input energy index path (built on first use)")
+    parser.add_argument("--energy_block",     type = int,   default = 1,    help = "Input samples per stored energy value (1 : exact)")
+    parser.add_argument("--min_rms",          type = float, default = 0,    help = "Input crops with a lower RMS are drawn again (0 : keep all)")
+    parser.add_argument("--precision",        type = str,   default = "float32", help = "Input crop and mixing dtype float32 or float64")
+    parser.add_argument("--out_dtype",        type = str,   default = "float32", help = "Input output sample dtype float32 or int16")
+    parser.add_argument("--codec",            type = str,   default = None, help = "Input output codec wav-float32, wav-int16 or flac (None : wav of out_dtype)")
+    parser.add_argument("--rir",              type = str,   default = None, help = "Input room impulse response folder (reverberant clean speech)")
+    parser.add_argument("--rir_prob",         type = float, default = 1.0,  help = "Input probability of a reverberant example")
+    parser.add_argument("--num_shards",  "--num-shards",  type = int, default = 1, help = "Input number of machines the job is split over")
+    parser.add_argument("--shard_index", "--shard-index", type = int, default = 0, help = "Input job shard of this machine (0 ~ num_shards - 1)")
+    parser.add_argument("--write_workers",    type = int,   default = 2,    help = "Input threads writing wav files behind the mixing (workers 1)")
+    parser.add_argument("--write_depth",      type = int,   default = 64,   help = "Input examples waiting to be written at most")
+    parser.add_argument("--metrics",          type = str,   default = None, help = "Input folder of per stage metrics (json and Prometheus textfile)")
+    parser.add_argument("--metrics_interval", type = float, default = 30,   help = "Input seconds between two metrics exports")
+    parser.add_argument("--profile",          type = int,   default = 0,    help = "Input 1 : also write a cProfile dump per process to the metrics folder")
     args = parser.parse_args()
 
     clean_source_path = args.cp
@@ -261,15 +888,31 @@ if __name__ == "__main__":
     split_length      = args.length
     iteration         = args.itera
     subset_length     = args.sub
+    seed              = args.seed
+    workers           = args.workers
+    batch_size        = args.batch
+    noise_bank_path   = args.nb
+    output_format     = args.format
+    shard_size        = args.shard_size
+    window_read       = bool(args.window)
+    use_hash          = bool(args.hash)
+    energy_path       = args.energy
+    energy_block      = args.energy_block
+    min_rms           = args.min_rms
+    precision         = args.precision
+    output_dtype      = args.out_dtype
+    output_codec      = args.codec
+    rir_path          = args.rir
+    rir_prob          = args.rir_prob
+    num_shards        = args.num_shards
+    shard_index       = args.shard_index
+    write_workers     = args.write_workers
+    write_depth       = args.write_depth
+
+    if args.metrics is not None or args.profile:
+        metrics.enable(export_path = args.metrics, interval = args.metrics_interval, profile = bool(args.profile))
     
-    if   SNR == 0:
-         SNR = np.random.randint(0, 5)
-    elif SNR == 1:
-         SNR = np.random.randint(-2, 3)
-    elif SNR == 2:
-         SNR = np.random.randint(-5, 0)
-    elif SNR == -1:
-         SNR = 0
+    SNR = snr_mode(SNR)
 
     resampling_factory = data_mixture(clean_source_path = clean_source_path,
                                       noise_source_path = noise_source_path,
@@ -280,7 +923,29 @@ if __name__ == "__main__":
                                       original_sampling = original_sampling,
                                       target_sampling   = target_sampling,
                                       split_length      = split_length,
-                                      iteration         = iteration)
-
-    resampling_factory.save(subset_length = subset_length)
+                                      iteration         = iteration,
+                                      seed              = seed,
+                                      noise_bank_path   = noise_bank_path,
+                                      output_format     = output_format,
+                                      shard_size        = shard_size,
+                                      window_read       = window_read,
+                                      energy_path       = energy_path,
+                                      energy_block      = energy_block,
+                                      min_rms           = min_rms,
+                                      precision         = precision,
+                                      output_dtype      = output_dtype,
+                                      output_codec      = output_codec,
+                                      rir_path          = rir_path,
+                                      rir_prob          = rir_prob)
+
+    resampling_factory.save(subset_length = subset_length,
+                            workers       = workers,
+                            use_hash      = use_hash,
+                            write_workers = write_workers,
+                            write_depth   = write_depth,
+                            num_shards    = num_shards,
+                            shard_index   = shard_index,
+                            batch_size    = batch_size)
+    metrics.close()
+    metrics.summary()
     print("-- THe END --")
@@ -0,0 +1,172 @@
+import os, json
+import numpy as np
+from tqdm import tqdm
+
+import scipy
+import scipy.io.wavfile
+
+from codec import read_sound, extensions as codec_extensions
+
+class noise_bank ():
+    """
+    Every noise source packed back to back in one contiguous array on disk.
+        bank_path/noise_bank.npy   : all noise samples, one after another
+        bank_path/noise_index.npy  : (N, 2) int64, offset and length of each noise in noise_bank.npy
+        bank_path/noise_files.json : [path, size, mtime_ns] of the source wav file of each row of noise_index.npy
+
+    def build       : One time step. Decode every noise file and pack it into the bank.
+    def is_current  : The bank was built from exactly these noise files, unchanged (otherwise build it again)
+    def __init__    : Open the bank with np.load(mmap_mode = "r"). Nothing is decoded, so this is instant.
+    def __getitem__ : Zero copy view of the i-th noise. (used exactly like the old list of decoded arrays)
+    def segment     : Zero copy view of [start, start + length) of the i-th noise.
+
+    The pages of the memmap live in the OS page cache, so forked mixing workers share one copy of the noise.
+    """
+    bank_name  = "noise_bank.npy"
+    index_name = "noise_index.npy"
+    files_name = "noise_files.json"
+
+    def __init__ (self, bank_path):
+        self.bank_path = bank_path
+        self.open()
+
+
+    def open (self):
+        self.bank  = np.load(os.path.join(self.bank_path, self.bank_name), mmap_mode = "r")
+        self.index = np.load(os.path.join(self.bank_path, self.index_name))
+
+        with open(os.path.join(self.bank_path, self.files_name), "r") as f:
+            self.file_state = json.load(f)
+        self.file_list = [state[0] if isinstance(state, list) else state for state in self.file_state]
+
+
+    def __getstate__ (self):
+        # Only the path is sent to spawned workers, they map the same file again
+        return {"bank_path" : self.bank_path}
+
+
+    def __setstate__ (self, state):
+        self.bank_path = state["bank_path"]
+        self.open()
+
+
+    def __len__ (self):
+        return len(self.index)
+
+
+    def __getitem__ (self, noise_index):
+        offset, length = self.index[noise_index]
+
+        return self.bank[offset : offset + length]
+
+
+    def segment (self, noise_index, start, length):
+        offset, noise_length = self.index[noise_index]
+        start                = min(start, noise_length)
+        stop                 = min(start + length, noise_length)
+
+        return self.bank[offset + start : offset + stop]
+
+
+    @classmethod
+    def exists (cls, bank_path):
+        return all(os.path.isfile(os.path.join(bank_path, name)) for name in [cls.bank_name, cls.index_name, cls.files_name])
+
+
+    @staticmethod
+    def source_state (path):
+        stat = os.stat(path)
+
+        return [path, stat.st_size, stat.st_mtime_ns]
+
+
+    @classmethod
+    def is_current (cls, bank_path, noise_file_list):
+        """
+        A bank of another (or an added, removed or changed) noise file list is stale, also a bank of the old
+        format that only stored the paths
+        """
+        if not(cls.exists(bank_path)):
+            return False
+        try:
+            with open(os.path.join(bank_path, cls.files_name), "r") as f:
+                return json.load(f) == [cls.source_state(path) for path in noise_file_list]
+        except (OSError, ValueError):
+            return False
+
+
+    @staticmethod
+    def read (path):
+        """
+        Samples of one noise file, a wav file is only mapped (codec.read_sound decodes the other codecs)
+        """
+        if not(path.lower().endswith(".wav")):
+            _, sound = read_sound(path)
+            return sound
+        _, sound = scipy.io.wavfile.read(path, mmap = True)
+
+        return sound
+
+
+    @classmethod
+    def build (cls, noise_file_list, bank_path):
+        """
+        1. Read only the length and dtype of every noise file (scipy.io.wavfile.read with mmap,
+           other codecs such as flac are decoded, see read)
+        2. Allocate the bank once with the total length
+        3. Copy every noise into its place
+        If the noise files have different dtypes the bank is stored as float32.
+        The files are written under temporary names and renamed at the end, so a broken build is never opened.
+        """
+        if not(os.path.isdir(bank_path)):
+            os.makedirs(bank_path)
+
+        lengths = []
+        dtypes  = set()
+        for path in tqdm(noise_file_list):
+            sound = cls.read(path)
+            if sound.ndim != 1:
+                raise ValueError(str(path) + " is not a mono sound file, the noise bank only stores mono noise")
+            lengths.append(len(sound))
+            dtypes.add(sound.dtype)
+            del sound
+
+        dtype   = dtypes.pop() if len(dtypes) == 1 else np.dtype(np.float32)
+        lengths = np.asarray(lengths, dtype = np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        index   = np.stack([offsets, lengths], axis = 1)
+
+        bank_file = os.path.join(bank_path, cls.bank_name + ".tmp")
+        bank      = np.lib.format.open_memmap(bank_file, mode = "w+", dtype = dtype, shape = (int(lengths.sum()), ))
+        for noise_index, path in tqdm(enumerate(noise_file_list), total = len(noise_file_list)):
+            sound = cls.read(path)
+            bank[offsets[noise_index] : offsets[noise_index] + lengths[noise_index]] = sound
+            del sound
+        bank.flush()
+        del bank
+
+        with open(os.path.join(bank_path, cls.index_name + ".tmp"), "wb") as f:
+            np.save(f, index)
+        with open(os.path.join(bank_path, cls.files_name + ".tmp"), "w") as f:
+            json.dump([cls.source_state(path) for path in noise_file_list], f)
+
+        for name in [cls.index_name, cls.files_name, cls.bank_name]:
+            os.replace(os.path.join(bank_path, name + ".tmp"), os.path.join(bank_path, name))
+        print("Completed building noise bank " + str(bank_path))
+
+        return cls(bank_path)
+
+
+if __name__ == "__main__":
+    import argparse
+    from discovery import file_index
+
+    parser = argparse.ArgumentParser(description = 'SETTING OPTION')
+    parser.add_argument("--np", type = str, default = "./datasets_original/train_noise", help = "Input noise path")
+    parser.add_argument("--bp", type = str, default = "./datasets/noise_bank",           help = "Input noise bank path")
+    args = parser.parse_args()
+
+    noise_file_list = file_index(args.np, extensions = codec_extensions(), probe_headers = False).files()
+
+    noise_bank.build(noise_file_list, args.bp)
+    print("-- THe END --")
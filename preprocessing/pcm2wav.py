@@ -7,6 +7,12 @@ import scipy
 import scipy.signal
 import scipy.io.wavfile
 import librosa
+from concurrent.futures import ThreadPoolExecutor
+
+from wav_io import wav_header_bytes
+from manifest import run_manifest
+from discovery import file_index
+import metrics
 
 class pcm2wav ():
     """
@@ -14,12 +20,19 @@ class pcm2wav ():
     1. 이 모듈을 이용해서 *.pcm파일을 *.wav 파일로 변환하면 float32가 아닌 int16 형으로 바뀜
     2. 그래서 *.wav 파일을 리로드하면 int16으로 바뀌고 librosa.load(파일 경로, sr = 16000) 옵션을 다시 권장
     3. librosa.load 메서드는 *.wav 파일을 불러와서 동시에 sr = 지정한 값으로 자동 Resampling and Normalize
+    4. *.wav 파일은 44 byte 헤더 + 원래 *.pcm 바이트이므로, 헤더만 쓰고 나머지는 커널에서 바로 복사 (copy_file_range / sendfile)
+       변환은 I/O 작업이므로 여러 파일을 thread pool에서 동시에 처리
+    5. save_path/.manifest.jsonl (manifest.py)에 변환이 끝난 파일을 기록, 다시 실행하면 새로 생기거나 바뀐 *.pcm 파일만 변환
     """
     def __init__ (self, load_path = "./korean_corpus", save_path = "./datasets/clean"):
+        # load_path = None : no directory scan, save_path = None : no output folder (read_pcm only, pipeline.py)
         self.load_path     = load_path
         self.save_path     = save_path
-        self.make_folder()
-        self.pcm_directory = self.read_directory()
+        self.pcm_directory = []
+        if self.save_path is not None:
+            self.make_folder()
+        if self.load_path is not None:
+            self.pcm_directory = self.read_directory()
 
 
     def make_folder (self):
@@ -29,44 +42,112 @@ class pcm2wav ():
 
 
     def read_directory (self):
-        pcm_folder_name = []
-        pcm_file_list   = []
-
-        for file in os.listdir(self.load_path):
-            pcm_folder_name.append(load_path + "/" + str(file))
-        print(load_path + " 이하의 폴더를 모두 불러오기 완료")
-
-        for name in pcm_folder_name:
-            for file in os.listdir(name):
-                if file.endswith(".pcm"):
-                    pcm_file_list.append(name + "/"+ file)
-        print(load_path + " 이하 폴더들의 모든 *.pcm 파일 불러오기 완료")
+        # load_path 이하의 모든 폴더를 병렬로 탐색 (discovery.py), 다음 실행부터는 바뀐 폴더만 다시 탐색
+        index_path    = None if self.save_path is None else self.save_path + "/.pcm_index.json"
+        pcm_file_list = file_index(self.load_path, index_path = index_path, extensions = [".pcm"], probe_headers = False).files()
+        print(self.load_path + " 이하 폴더들의 모든 *.pcm 파일 불러오기 완료")
         
         return pcm_file_list
 
 
+    def read_pcm (self, pcm_file_path, channels = 1, bit_depth = 16):
+        """
+        *.pcm file to numpy array without writing a *.wav file (int16 for bit_depth 16, like scipy.io.wavfile.read)
+        """
+        dtype = {8 : "u1", 16 : "<i2", 32 : "<i4"}[bit_depth]
+        with metrics.timer("read"):
+            sound = np.fromfile(pcm_file_path, dtype = dtype)
+        sound = sound[:len(sound) - len(sound) % channels]
+
+        return sound.reshape(-1, channels) if channels > 1 else sound
+
+
+    def copy_payload (self, source, target, size, chunk_size = 1 << 20):
+        """
+        Copy "size" bytes from the current position of source to target without going through Python buffers
+        if the OS allows it (copy_file_range, then sendfile), otherwise in chunks of chunk_size.
+        """
+        for name in ["copy_file_range", "sendfile"]:
+            if not hasattr(os, name):
+                continue
+            try:
+                remaining = size
+                while remaining > 0:
+                    if name == "copy_file_range":
+                        copied = os.copy_file_range(source.fileno(), target.fileno(), remaining)
+                    else:
+                        copied = os.sendfile(target.fileno(), source.fileno(), None, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+
+            except OSError:
+                if remaining != size:
+                    raise
+
+        while size > 0:
+            chunk = source.read(min(chunk_size, size))
+            if not chunk:
+                break
+            target.write(chunk)
+            size -= len(chunk)
+
+
+    def wav_path (self, pcm_file_path):
+        pcm_file_name = os.path.splitext(os.path.basename(pcm_file_path))[0]
+
+        return self.save_path + "/" + str(pcm_file_name) + ".wav"
+
+
+    def convert (self, pcm_file_path, channels = 1, bit_depth = 16, sampling_rate = 16000):
+        """
+        Write the 44 byte wav header and then the *.pcm bytes unchanged (only whole frames, like the wave module)
+        """
+        wav_file_path = self.wav_path(pcm_file_path)
+
+        block_align   = channels * bit_depth // 8
+        data_size     = os.path.getsize(pcm_file_path)
+        data_size     = data_size - data_size % block_align
+
+        # The payload is copied in the kernel, reading the *.pcm file and writing the *.wav file are one step
+        with metrics.timer("write"):
+            with open(pcm_file_path, 'rb') as opened_pcm_file, open(wav_file_path, 'wb') as opened_wav_file:
+                opened_wav_file.write(wav_header_bytes(sampling_rate, channels, bit_depth, data_size = data_size))
+                opened_wav_file.flush()
+                self.copy_payload(opened_pcm_file, opened_wav_file, data_size)
+                if data_size % 2:
+                    opened_wav_file.write(b"\x00")
+        metrics.count("files")
+
+
     # The parameters are prerequisite information. More specifically,
     # channels, bit_depth, sampling_rate must be known to use this function.
-    def start (self, channels = 1, bit_depth = 16, sampling_rate = 16000):
+    def start (self, channels = 1, bit_depth = 16, sampling_rate = 16000, workers = 8, use_hash = False):
+        # Check if the options are valid.
+        if bit_depth % 8 != 0:
+            raise ValueError("bit_depth "+str(bit_depth)+" must be a multiple of 8.")
+
+        # Skip every *.pcm file that was already converted with the same options and has not changed
+        manifest = run_manifest(self.save_path, {"channels" : channels, "bit_depth" : bit_depth, "sampling_rate" : sampling_rate},
+                                use_hash = use_hash)
+        todo     = [path for path in self.pcm_directory if not manifest.is_done(path, [path], [self.wav_path(path)])]
+        print(str(len(self.pcm_directory) - len(todo)) + " 개 파일은 이미 변환 완료, " + str(len(todo)) + " 개 파일 변환 시작")
 
-        for index, pcm_file_path in tqdm(enumerate (self.pcm_directory)):
-            # Check if the options are valid.
-            if bit_depth % 8 != 0:
-                raise ValueError("bit_depth "+str(bit_depth)+" must be a multiple of 8.")
+        def convert (pcm_file_path):
+            self.convert(pcm_file_path, channels, bit_depth, sampling_rate)
+            manifest.record(pcm_file_path, [pcm_file_path], [self.wav_path(pcm_file_path)])
 
-            pcm_file_name = os.path.splitext(os.path.basename(pcm_file_path))[0]
-            wav_file_path = self.save_path + "/" + str(pcm_file_name) + ".wav"
-                
-            # Read the .pcm file as a binary file and store the data to pcm_data
-            with open(pcm_file_path, 'rb') as opened_pcm_file:
-                pcm_data  = opened_pcm_file.read()
-                
-                obj2write = wave.open(wav_file_path, 'wb')
-                obj2write.setnchannels(channels )
-                obj2write.setsampwidth(bit_depth // 8)
-                obj2write.setframerate(sampling_rate)
-                obj2write.writeframes(pcm_data)
-                obj2write.close()
+        if workers <= 1:
+            for pcm_file_path in tqdm(todo):
+                convert(pcm_file_path)
+
+        else:
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                for _ in tqdm(executor.map(convert, todo), total = len(todo)):
+                    pass
+
+        manifest.close()
 
 
 
@@ -74,10 +155,23 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = 'SETTING PATH')
     parser.add_argument("--load_path", type = str, default = "./korean_corpus",  help = "Input load_path (for *.pcm file")
     parser.add_argument("--save_path", type = str, default = "./datasets/clean", help = "Input save_path (for *.wav file")
+    parser.add_argument("--workers",   type = int, default = 8,                  help = "Input number of conversion threads")
+    parser.add_argument("--hash",      type = int, default = 0,                  help = "Input 1 : detect changed *.pcm files by sha1 instead of size and mtime")
+    parser.add_argument("--metrics",          type = str,   default = None, help = "Input folder of per stage metrics (json and Prometheus textfile)")
+    parser.add_argument("--metrics_interval", type = float, default = 30,   help = "Input seconds between two metrics exports")
+    parser.add_argument("--profile",          type = int,   default = 0,    help = "Input 1 : also write a cProfile dump to the metrics folder")
     args = parser.parse_args()
 
     load_path       = args.load_path
     save_path       = args.save_path
+    workers         = args.workers
+    use_hash        = bool(args.hash)
+
+    if args.metrics is not None or args.profile:
+        metrics.enable(export_path = args.metrics, interval = args.metrics_interval, profile = bool(args.profile))
+
     pcm2wav_factory = pcm2wav(load_path=load_path, save_path=save_path)
-    pcm2wav_factory.start()
+    pcm2wav_factory.start(workers = workers, use_hash = use_hash)
+    metrics.close()
+    metrics.summary()
     print("-- THe END --")
@@ -0,0 +1,268 @@
+import queue, argparse, threading
+from tqdm import tqdm
+
+from pcm2wav import pcm2wav
+from resample import resampler
+from mixture import data_mixture, snr_mode
+from codec import read_sound
+import metrics
+
+class stage_pipeline ():
+    """
+    Stages connected by bounded queues, every stage runs on its own worker threads.
+        add_stage(name, function, workers) : function(item) returns the item for the next stage (None drops it)
+        run(items)                         : feed items, yield what comes out of the last stage
+
+    A full queue blocks the stage in front of it (backpressure), so at most queue_size items wait between two stages.
+    The first exception of any stage stops every stage and is raised again in run.
+    """
+    def __init__ (self, queue_size = 64):
+        self.queue_size = queue_size
+        self.stages     = []
+
+
+    def add_stage (self, name, function, workers = 1):
+        self.stages.append((name, function, max(1, workers)))
+
+
+    def run (self, items):
+        done    = object()
+        stop    = threading.Event()
+        errors  = []
+        queues  = [queue.Queue(maxsize = self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = []
+
+        def put (target, item):
+            while not stop.is_set():
+                try:
+                    target.put(item, timeout = 0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get (source):
+            while not stop.is_set():
+                try:
+                    return source.get(timeout = 0.1)
+                except queue.Empty:
+                    continue
+            return done
+
+        def feed ():
+            try:
+                for item in items:
+                    if not put(queues[0], item):
+                        return
+                put(queues[0], done)
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+
+        def work (stage_index, function, remaining, lock):
+            source, target = queues[stage_index], queues[stage_index + 1]
+            try:
+                while True:
+                    item = get(source)
+                    if item is done:
+                        # Let the other workers of this stage see the end too, the last one passes it on
+                        put(source, done)
+                        with lock:
+                            remaining[0] -= 1
+                            last = remaining[0] == 0
+                        if last:
+                            put(target, done)
+                        return
+
+                    result = function(item)
+                    if result is not None and not put(target, result):
+                        return
+
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+
+        threads.append(threading.Thread(target = feed, daemon = True))
+        for stage_index, (name, function, workers) in enumerate(self.stages):
+            remaining, lock = [workers], threading.Lock()
+            for _ in range(workers):
+                threads.append(threading.Thread(target = work, args = (stage_index, function, remaining, lock),
+                                                name = name, daemon = True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = get(queues[-1])
+                if item is done:
+                    break
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+
+class pipeline ():
+    """
+    PCM/WAV -> resample -> mix in one pass, without writing the intermediate corpora.
+    The stages are the pcm2wav, resampler and data_mixture logic working on arrays in memory.
+        decode   : pcm2wav.read_pcm (*.pcm) or codec.read_sound (*.wav, *.flac)
+        resample : resampler.data_normalize + polyphase resampling from the rate of the file to target_sampling
+        mix      : data_mixture.make_example with the decoded sound (same seeding as mixture.py)
+        write    : data_mixture.data_write of noisy and clean (encoded with the codec of the mixer on the write threads)
+
+    keep_wav_path       : also keep the converted wav files (pcm input only)
+    keep_resampled_path : also keep the resampled float32 wav files
+    Example names and seeds come from the index in data_mixture.clean_source, as in mixture.py.
+    """
+    def __init__ (self, mixer, input_format = "pcm", channels = 1, bit_depth = 16, keep_wav_path = None,
+                        keep_resampled_path = None, queue_size = 64):
+        self.mixer        = mixer
+        self.input_format = input_format
+        self.channels     = channels
+        self.bit_depth    = bit_depth
+        self.queue_size   = queue_size
+
+        if self.input_format not in ["pcm", "wav"]:
+            raise ValueError("input_format must be pcm or wav, not " + str(self.input_format))
+
+        self.converter = pcm2wav(load_path = None, save_path = keep_wav_path)
+        self.resampler = resampler(base_file_path    = None,
+                                   save_file_path    = keep_resampled_path,
+                                   save_file_name    = "",
+                                   original_sampling = mixer.original_sampling,
+                                   target_sampling   = mixer.target_sampling)
+
+
+    def decode (self, item):
+        index, path = item
+
+        if self.input_format == "pcm":
+            sound = self.converter.read_pcm(path, self.channels, self.bit_depth)
+            rate  = self.mixer.original_sampling
+            if self.converter.save_path is not None:
+                self.converter.convert(path, self.channels, self.bit_depth, rate)
+
+        else:
+            with metrics.timer("read"):
+                rate, sound = read_sound(path)
+
+        return index, sound, rate
+
+
+    def resample (self, item):
+        index, sound, rate = item
+
+        sound = self.resampler.data_normalize(sound)
+        with metrics.timer("resample"):
+            sound = self.resampler.polyphase.resample(sound, rate, self.mixer.target_sampling)
+        sound = self.resampler.data_convert2float32(sound)
+        if self.resampler.save_file_path is not None:
+            self.resampler.save_scipy(sound, index)
+
+        return index, sound
+
+
+    def mix (self, item):
+        index, sound = item
+
+        noisy, clean, meta = self.mixer.make_example(index, sound = sound)
+
+        return index, noisy, clean
+
+
+    def write (self, item):
+        index, noisy, clean = item
+
+        self.mixer.data_write(self.mixer.noisy_file_path, noisy, index = index)
+        self.mixer.data_write(self.mixer.clean_file_path, clean, index = index)
+
+        return index
+
+
+    def run (self, decode_workers = 4, resample_workers = 4, mix_workers = 2, write_workers = 2):
+        stages = stage_pipeline(self.queue_size)
+        stages.add_stage("decode",   self.decode,   decode_workers)
+        stages.add_stage("resample", self.resample, resample_workers)
+        stages.add_stage("mix",      self.mix,      mix_workers)
+        stages.add_stage("write",    self.write,    write_workers)
+
+        items = list(enumerate(self.mixer.clean_source))
+        for _ in tqdm(stages.run(items), total = len(items)):
+            pass
+
+        print("Complete dataset production using sound source")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'SETTING OPTION')
+    parser.add_argument("--lp",     type = str, default = "./korean_corpus",                 help = "Input source path (*.pcm or *.wav)")
+    parser.add_argument("--input",  type = str, default = "pcm",                             help = "Input source format pcm or wav")
+    parser.add_argument("--np",     type = str, default = "./datasets_original/train_noise", help = "Input noise path")
+    parser.add_argument("--sp",     type = str, default = "./datasets/short",                help = "Input save path")
+    parser.add_argument("--nn",     type = str, default = "train_noisy",                     help = "Input noisy name")
+    parser.add_argument("--cn",     type = str, default = "train_clean",                     help = "Input clean name")
+    parser.add_argument("--snr",    type = int, default = 0,     help = "0 : 0 ~ 5, 1 : -2 ~ 3, 2 : -5 ~ 0 (drawn per example from the seed), -1 : 0")
+    parser.add_argument("--os",     type = int, default = 16000, help = "Input original sampling (pcm input)")
+    parser.add_argument("--ts",     type = int, default = 16000, help = "Input target sampling")
+    parser.add_argument("--length", type = int, default = 16384, help = "Input split length")
+    parser.add_argument("--seed",   type = int, default = 0,     help = "Input base seed (example i uses seed + i)")
+    parser.add_argument("--nb",     type = str, default = None,  help = "Input noise bank path (built on first use)")
+    parser.add_argument("--channels",  type = int, default = 1,  help = "Input pcm channels")
+    parser.add_argument("--bit_depth", type = int, default = 16, help = "Input pcm bit depth")
+    parser.add_argument("--keep_wav",       type = str, default = None, help = "Input folder to keep converted wav files")
+    parser.add_argument("--keep_resampled", type = str, default = None, help = "Input folder to keep resampled wav files")
+    parser.add_argument("--codec",          type = str, default = None, help = "Input output codec wav-float32, wav-int16 or flac")
+    parser.add_argument("--rir",            type = str,   default = None, help = "Input room impulse response folder (reverberant clean speech)")
+    parser.add_argument("--rir_prob",       type = float, default = 1.0,  help = "Input probability of a reverberant example")
+    parser.add_argument("--queue",            type = int, default = 64, help = "Input items waiting between two stages")
+    parser.add_argument("--decode_workers",   type = int, default = 4,  help = "Input decode threads")
+    parser.add_argument("--resample_workers", type = int, default = 4,  help = "Input resample threads")
+    parser.add_argument("--mix_workers",      type = int, default = 2,  help = "Input mix threads")
+    parser.add_argument("--write_workers",    type = int, default = 2,  help = "Input write threads")
+    parser.add_argument("--metrics",          type = str,   default = None, help = "Input folder of per stage metrics (json and Prometheus textfile)")
+    parser.add_argument("--metrics_interval", type = float, default = 30,   help = "Input seconds between two metrics exports")
+    parser.add_argument("--profile",          type = int,   default = 0,    help = "Input 1 : also write a cProfile dump to the metrics folder")
+    args = parser.parse_args()
+
+    if args.metrics is not None or args.profile:
+        metrics.enable(export_path = args.metrics, interval = args.metrics_interval, profile = bool(args.profile))
+
+    SNR = snr_mode(args.snr)
+
+    mixer = data_mixture(clean_source_path = args.lp,
+                         noise_source_path = args.np,
+                         save_file_path    = args.sp,
+                         noisy_name        = args.nn,
+                         clean_name        = args.cn,
+                         SNR               = SNR,
+                         original_sampling = args.os,
+                         target_sampling   = args.ts,
+                         split_length      = args.length,
+                         seed              = args.seed,
+                         noise_bank_path   = args.nb,
+                         window_read       = False,
+                         output_codec      = args.codec,
+                         rir_path          = args.rir,
+                         rir_prob          = args.rir_prob,
+                         clean_extensions  = [".pcm"] if args.input == "pcm" else None)
+
+    fused = pipeline(mixer,
+                     input_format        = args.input,
+                     channels            = args.channels,
+                     bit_depth           = args.bit_depth,
+                     keep_wav_path       = args.keep_wav,
+                     keep_resampled_path = args.keep_resampled,
+                     queue_size          = args.queue)
+
+    fused.run(decode_workers   = args.decode_workers,
+              resample_workers = args.resample_workers,
+              mix_workers      = args.mix_workers,
+              write_workers    = args.write_workers)
+    metrics.close()
+    metrics.summary()
+    print("-- THe END --")
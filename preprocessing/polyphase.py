@@ -0,0 +1,93 @@
+import math
+import numpy as np
+
+import scipy
+import scipy.signal
+
+class polyphase_resampler ():
+    """
+    Polyphase resampling (scipy.signal.resample_poly) with one cached low pass filter per rate pair.
+    A corpus usually has only a few source rates (8000, 22050, 44100, 48000),
+    so the filter is designed once per (original, target) ratio and reused for every file.
+
+    def ratio          : (up, down) of a rate pair, reduced by the gcd
+    def filter         : cached FIR filter of a rate pair (the same design resample_poly uses by default)
+    def resample       : one signal, time on "axis" (0 for scipy.io.wavfile data, also (frames, channels))
+    def resample_batch : (B, frames) same rate, same length signals in one 2-D call
+    def resample_stream: a long signal block by block with bounded memory
+    """
+    def __init__ (self, window = ("kaiser", 5.0)):
+        self.window  = window
+        self.filters = {}
+
+
+    def ratio (self, original_sampling, target_sampling):
+        gcd = math.gcd(int(original_sampling), int(target_sampling))
+
+        return int(target_sampling) // gcd, int(original_sampling) // gcd
+
+
+    def filter (self, original_sampling, target_sampling):
+        up, down = self.ratio(original_sampling, target_sampling)
+
+        if (up, down) not in self.filters:
+            max_rate = max(up, down)
+            half_len = 10 * max_rate
+            self.filters[(up, down)] = scipy.signal.firwin(2 * half_len + 1, 1. / max_rate, window = self.window)
+
+        return self.filters[(up, down)]
+
+
+    def resample (self, data, original_sampling, target_sampling, axis = 0):
+        if original_sampling == target_sampling:
+            return data
+
+        up, down = self.ratio(original_sampling, target_sampling)
+
+        return scipy.signal.resample_poly(data, up, down, axis = axis,
+                                          window = self.filter(original_sampling, target_sampling))
+
+
+    def resample_batch (self, batch, original_sampling, target_sampling):
+        return self.resample(np.asarray(batch), original_sampling, target_sampling, axis = 1)
+
+
+    def resample_stream (self, read, frames, original_sampling, target_sampling, block_frames = 65536):
+        """
+        Resample a signal of "frames" input frames block by block, yielding the output blocks in order.
+            read(start, length) : returns input frames [start, start + length), time on axis 0
+
+        Every block is read with "context" extra frames on both sides, enough to cover the filter,
+        and only the outputs whose filter support lies inside the read segment are kept.
+        Blocks start on multiples of "down", so every output sample is exactly the one resample
+        would give for the whole signal, and only block_frames + 2 * context frames are in memory.
+        """
+        if original_sampling == target_sampling:
+            for start in range(0, frames, block_frames):
+                yield read(start, min(block_frames, frames - start))
+
+            return
+
+        up, down = self.ratio(original_sampling, target_sampling)
+        half_len = (len(self.filter(original_sampling, target_sampling)) - 1) // 2
+
+        def round_up (value):
+            return -(-value // down) * down
+
+        context      = round_up(half_len // up + 2)
+        block_frames = round_up(max(block_frames, down))
+        total_output = -(-frames * up // down)
+
+        for start in range(0, frames, block_frames):
+            stop          = min(start + block_frames, frames)
+            segment_start = max(0, start - context)
+            segment_stop  = min(frames, stop + context)
+
+            segment = read(segment_start, segment_stop - segment_start)
+            output  = self.resample(segment, original_sampling, target_sampling, axis = 0)
+
+            # segment_start is a multiple of down, so local output j is global output segment_start * up / down + j
+            output_start = start * up // down - segment_start * up // down
+            output_stop  = (total_output if stop == frames else stop * up // down) - segment_start * up // down
+
+            yield output[output_start : output_stop]
@@ -1,4 +1,4 @@
-import os, argparse
+import os, time, struct, shutil, argparse, collections, multiprocessing
 import wave, natsort
 import numpy as np
 from tqdm import tqdm
@@ -7,6 +7,14 @@ import scipy
 import scipy.signal
 import scipy.io.wavfile
 import librosa
+
+from polyphase import polyphase_resampler
+from wav_io import read_wav_header, read_wav_window
+from codec import get_codec
+from manifest import run_manifest, shard_indices
+from discovery import file_index
+from write_behind import write_behind
+import metrics
 """
 원음의 샘플링 레이트를 파악한다.
 샘플링 레이트를 설정한다. (VoIP 기준 16,000 sampling rate)
@@ -18,7 +26,7 @@ librosa.load를 이용한다. librosa.load("파일 경로", sr = target_sampling
 따라서 권장하는 리샘플링 방법
     "./folder/*.wav" 폴더를 준비 (샘플렝 레이트가 무엇이든 상관 없음)
     librosa.load 메서드로 리샘플링까지 시행
-    librosa.output.write_wav 메서드로 새로운 폴더에 저장
+    codec.py의 codec으로 새로운 폴더에 저장 (librosa.output.write_wav는 librosa 0.8에서 삭제됨)
     음성 폴더 하나씩 할 것
 
 기본적인 resampling 준비 (class data_dloader)
@@ -35,8 +43,9 @@ class resampler ():
         def data_convert2float32
         def data_split
         def data_resampler
+        def data_resampler_poly
 
-        original_sampling : 원 *.wav 파일의 샘플링 레이트
+        original_sampling : 원 *.wav 파일의 샘플링 레이트 (None이면 파일마다 header에서 읽음)
         target_sampling   : 원하는 샘플링 레이트
         base_file_path : 소리 소스가 저장되어 있는 폴더
         load_file_name : 소리 소스가 있는 폴더에서 어떤 소리의 폴더를 가지고 올 것인지 선택
@@ -54,42 +63,161 @@ class resampler ():
             self.data_resampling
             self.data_conver2float32
 
-        3. 가급적이면 데이터의 sampling rate를 미리 알아서 librosa 옵션을 사용할 것
+        3. poly 옵션
+            scipy 옵션과 같지만 data_resampler_poly (polyphase.py, rate 쌍마다 필터를 한 번만 설계)
+            길이가 같은 파일들은 batch_size개씩 묶어서 한 번의 2-D 호출로 리샘플링
+            stream 옵션 : block_frames씩 읽고 리샘플링해서 바로 이어 쓰기 (아주 긴 녹음도 메모리 몇 MB)
+
+        4. 가급적이면 데이터의 sampling rate를 미리 알아서 librosa 옵션을 사용할 것
+        5. data_save(option, workers = N) : 파일들을 N개의 프로세스로 나누어 처리 (출력 파일 이름은 workers와 무관)
+        6. 저장 폴더의 .manifest.jsonl (manifest.py)에 끝난 파일을 기록, 다시 실행하면 새로 생기거나 바뀐 파일만 처리
+        7. precision : 정규화와 리샘플링의 dtype (float32 권장, float64 임시 배열 없이 한 버퍼에서 in place 정규화)
+           output_dtype : 저장 파일의 dtype, float32 또는 int16 (파일 크기 절반)
+        8. output_codec : 저장 파일의 codec (codec.py), wav-float32, wav-int16 또는 flac (None이면 output_dtype의 wav)
+           변환과 인코딩은 write_behind 스레드 또는 각 프로세스에서 실행
+        9. probe : 파일마다 header만 읽어서 sampling rate, channels, dtype 확인 (discovery.py의 file index, decode 없음)
+           sampling rate가 target_sampling이고 dtype이 출력 wav codec과 같은 파일은 리샘플링 없이 hardlink 또는 copy (fast_path)
+           sampling rate가 섞인 폴더는 source rate별로 묶어서 처리 (그룹마다 하나의 resampling 설정)
     '''
     def __init__ (self, base_file_path    = "./original",
                         save_file_path    = "./datasets",
                         save_file_name    = "test_clean",
-                        original_sampling = 16000,
-                        target_sampling   = 16000):
-
-        def walk_filename (file_path):
-            file_list = []
-
-            for root, dirs, files in tqdm(os.walk(file_path)):
-                for fname in files:
-                    if fname == "desktop.ini" or fname == ".DS_Store": continue 
-                    full_fname = os.path.join(root, fname)
-                    file_list.append(full_fname)
-
-            file_list = natsort.natsorted(file_list, reverse = False)
-            
-            return file_list
+                        original_sampling = None,
+                        target_sampling   = 16000,
+                        batch_size        = 16,
+                        block_frames      = 65536,
+                        precision         = "float32",
+                        output_dtype      = "float32",
+                        output_codec      = None,
+                        fast_path         = "link"):
 
         self.original_sampling = original_sampling
         self.target_sampling   = target_sampling
+        self.batch_size        = batch_size
+        self.block_frames      = block_frames
+        self.polyphase         = polyphase_resampler()
+        self.precision         = np.dtype(precision)
+        self.output_dtype      = output_dtype
+        self.output_codec      = output_codec if output_codec is not None else "wav-" + output_dtype
+        self.codec             = get_codec(self.output_codec)
+        self.fast_path         = fast_path
+        if self.fast_path not in ["link", "copy", "none"]:
+            raise ValueError("fast_path must be link, copy or none, not " + str(self.fast_path))
         self.file_path         = base_file_path
-        self.file_list         = walk_filename(self.file_path)
+        self.file_list         = []
+        self.file_index        = None
+        self.save_file_path    = None
+        # Set by data_save for the serial path: write_behind queue of the output writes, called with the index of every written file
+        self.writer            = None
+        self.on_written        = None
 
-        # "./datasets/test_clean"
-        self.save_file_path    = save_file_path + "/" + save_file_name
+        # base_file_path = None, save_file_path = None : in memory use only (pipeline.py)
+        if save_file_path is not None:
+            # "./datasets/test_clean"
+            self.save_file_path = save_file_path + "/" + save_file_name
 
-        # Check save_file_path -> create folder
-        print("Check folder path ::: ", self.save_file_path)
-        if not(os.path.isdir(self.save_file_path)): 
-            os.makedirs(self.save_file_path)
+            # Check save_file_path -> create folder
+            print("Check folder path ::: ", self.save_file_path)
+            if not(os.path.isdir(self.save_file_path)): 
+                os.makedirs(self.save_file_path)
+
+        if self.file_path is not None:
+            # Cached, naturally ordered file list with wav headers (discovery.py)
+            index_path         = None if self.save_file_path is None else self.save_file_path + "/.source_index.json"
+            self.file_index    = file_index(self.file_path, index_path = index_path)
+            self.file_list     = self.file_index.files()
         
 
-    def load_librosa (self):
+    def output_path (self, index):
+        """
+        Output file of the index-th input file ("{:07d}".format(index+1) + codec extension), the same for any number of workers
+        """
+        return self.save_file_path + "/" + "{:07d}".format(index+1) + self.codec.extension
+
+
+    def probe (self, path):
+        """
+        Header of a source file (sampling_rate, channels, dtype, frames) without decoding the sound,
+        from the file index (discovery.py) or read now. None if the file has no readable wav header.
+        """
+        header = None if self.file_index is None else self.file_index.header(path)
+        if header is None:
+            try:
+                header = read_wav_header(path)
+            except (ValueError, struct.error, OSError):
+                header = None
+
+        return header
+
+
+    def source_rate (self, path):
+        """
+        Sampling rate of a source file, original_sampling if it is set (it overrides the headers)
+        """
+        if self.original_sampling is not None:
+            return self.original_sampling
+
+        header = self.probe(path)
+        if header is None:
+            raise ValueError(str(path) + " has no readable wav header, set original_sampling (--os)")
+
+        return header["sampling_rate"]
+
+
+    def group_rate (self, path):
+        """
+        source_rate, None instead of an error for a file without a readable header
+        """
+        header = self.probe(path)
+        if self.original_sampling is not None or header is None:
+            return self.original_sampling
+
+        return header["sampling_rate"]
+
+
+    def is_passthrough (self, path, option = None):
+        """
+        The source is already at target_sampling in the sample format of the output wav codec,
+        so the output is the source itself. (An int16 source skips the normalize and convert round trip,
+        which can move a sample by one step.)
+        option : librosa.load mixes every file down to mono, so with the librosa option only mono files are passed through
+        """
+        if self.fast_path == "none" or self.codec.extension != ".wav":
+            return False
+
+        header = self.probe(path)
+        if header is None or header["dtype"] is None:
+            return False
+
+        if option == "librosa" and header["channels"] != 1:
+            return False
+
+        return (self.source_rate(path) == self.target_sampling and header["sampling_rate"] == self.target_sampling
+                and np.dtype(header["dtype"]) == np.dtype(self.codec.dtype))
+
+
+    def copy_source (self, path, output):
+        """
+        Hardlink (fast_path "link") or copy the source to the output, under a temporary name first
+        """
+        temp = output + ".tmp"
+        if os.path.exists(temp):
+            os.remove(temp)
+
+        linked = False
+        if self.fast_path == "link":
+            try:
+                os.link(path, temp)
+                linked = True
+            except OSError:
+                # Another file system (or no hardlinks), copy instead
+                linked = False
+        if not(linked):
+            shutil.copyfile(path, temp)
+        os.replace(temp, output)
+
+
+    def load_librosa (self, index, path):
         """
         librosa_load (wav file to numpy array with normalize, resampling)
         1. load file (Default sampling 22050)
@@ -97,10 +225,13 @@ class resampler ():
         3. resampling to "self.target_sampling"
         4. 여기서는 원 .wav 파일의 sampling rate가 필요 없음
         """
-        for index, data in tqdm(enumerate (self.file_list)):
-            sound, sampling_rate = librosa.load(data, sr = self.target_sampling)
-            librosa.output.write_wav(self.save_file_path + "/" + "{:07d}".format(index+1) + ".wav", sound, self.target_sampling)
-        
+        # librosa.load reads, normalizes and resamples in one call
+        with metrics.timer("resample"):
+            sound, sampling_rate = librosa.load(path, sr = self.target_sampling)
+        self.save_output(index, self.codec.write, self.output_path(index), sound, self.target_sampling)
+
+        return sound
+
 
     def load_scipy (self, path):
         """
@@ -112,7 +243,8 @@ class resampler ():
         4. Extract sampling rate and quantization data
         5. You need to normalize data
         """
-        sr, sound = scipy.io.wavfile.read(path)
+        with metrics.timer("read"):
+            sr, sound = scipy.io.wavfile.read(path)
         
         return sound
     
@@ -120,51 +252,332 @@ class resampler ():
     def data_normalize (self, data):
         """
         If dtype int16, normalize -1 ~ 1
+        Any integer dtype is mapped from its full range to -1 ~ 1 the same way, a float sound is only converted.
+        One buffer of the precision dtype, every step is done in place (no float64 temporaries).
         """
-        data = data + (2**15)
-        data = data / ((2**16) - 1)
-        data = 2 * data
-        data = data - 1
+        with metrics.timer("decode"):
+            if not(np.issubdtype(data.dtype, np.integer)):
+                return np.asarray(data, dtype = self.precision)
 
-        return data
+            info    = np.iinfo(data.dtype)
+            result  = np.array(data, dtype = self.precision)
+            result -= info.min
+            result *= 2 / (int(info.max) - int(info.min))
+            result -= 1
+
+        return result
     
     
-    def data_resampler (self, data):
+    def data_resampler (self, data, original_sampling = None):
         """
         original sampling rate to target sampling rate
+        original_sampling : rate of this file, self.original_sampling if None
+        Time is axis 0 (scipy.io.wavfile data, also (frames, channels)), so a multichannel file keeps its channels.
         """
-        data = librosa.resample(data, orig_sr = original_sampling, target_sr = self.target_sampling)
+        if original_sampling is None:
+            original_sampling = self.original_sampling
+        with metrics.timer("resample"):
+            data = librosa.resample(data, orig_sr = original_sampling, target_sr = self.target_sampling, axis = 0)
         
         return data
 
 
+    def data_resampler_poly (self, data, axis = 0, original_sampling = None):
+        """
+        original sampling rate to target sampling rate with the cached polyphase filter of this rate pair
+        original_sampling : rate of this file, self.original_sampling if None
+        """
+        if original_sampling is None:
+            original_sampling = self.original_sampling
+        with metrics.timer("resample"):
+            return self.polyphase.resample(data, original_sampling, self.target_sampling, axis = axis)
+
+
     def data_convert2float32 (self, data):
         """
         datatype convert to float32
         """
-        data = data.astype(np.float32)
+        with metrics.timer("decode"):
+            data = np.asarray(data, dtype = np.float32)
 
         return data
 
 
-    def save_scipy (self, data):
-        scipy.io.wavfile.write(self.save_file_path, sr = self.target_sampling, data = data)
+    def save_scipy (self, data, index):
+        self.save_output(index, self.codec.write, self.output_path(index), data, self.target_sampling)
 
 
-    def data_save (self, option = "librosa"):
-        print("Option is ", option)
-        if option == "librosa": 
-            self.load_librosa()
+    def save_output (self, index, write, *args):
+        """
+        write(*args) now, or on the write_behind queue while the next file is resampled
+        """
+        if self.writer is None:
+            self.write_output(index, write, *args)
+        else:
+            self.writer.submit(self.write_output, index, write, *args)
+
+
+    def write_output (self, index, write, *args):
+        with metrics.timer("write"):
+            write(*args)
+        if self.on_written is not None:
+            self.on_written(index)
+
+
+    def stream_file (self, index, path):
+        """
+        Resample one file in blocks of block_frames (polyphase.resample_stream) and append every block
+        to the output file (codec.stream), so peak memory does not depend on the length of the recording.
+            return number of output frames
+        """
+        header = self.probe(path)
+        if header is None or header["dtype"] is None:
+            raise ValueError(str(path) + " has a sample format that can not be streamed")
+
+        def read (start, length):
+            with metrics.timer("read"):
+                window = read_wav_window(path, start, length, header)
+
+            return self.data_normalize(window)
+
+        frames = 0
+        blocks = self.polyphase.resample_stream(read, header["frames"], self.source_rate(path),
+                                                self.target_sampling, self.block_frames)
+        with self.codec.stream(self.output_path(index), self.target_sampling, header["channels"]) as writer:
+            while True:
+                # The next block reads its input window inside, that time goes to read and decode
+                with metrics.timer("resample"):
+                    block = next(blocks, None)
+                if block is None:
+                    break
+                with metrics.timer("write"):
+                    writer.write(block)
+                frames += len(block)
+
+        return frames
+
+
+    def process_file (self, index, path, option):
+        """
+        load - resample - write of one file
+            return (process id, seconds, seconds of output audio)
+        """
+        start = time.time()
+
+        if self.is_passthrough(path, option):
+            # Nothing to resample or convert, the write queue links or copies the file
+            self.save_output(index, self.copy_source, path, self.output_path(index))
+            metrics.count("copied")
+
+            return os.getpid(), time.time() - start, self.probe(path)["frames"] / self.target_sampling
+
+        if option == "librosa":
+            sound = self.load_librosa(index, path)
 
         elif option == "scipy":
-            for index, path in tqdm(enumerate (self.file_list)):
-                sound = self.load_scipy(path)
-                sound = self.data_normalize(sound)
-                sound = self.data_resampler(sound)
-                sound = self.data_convert2float32(sound)
-                self.save_scipy(sound)
+            sound = self.load_scipy(path)
+            sound = self.data_normalize(sound)
+            sound = self.data_resampler(sound, self.source_rate(path))
+            sound = self.data_convert2float32(sound)
+            self.save_scipy(sound, index)
+
+        elif option == "poly":
+            sound = self.load_scipy(path)
+            sound = self.data_normalize(sound)
+            sound = self.data_resampler_poly(sound, original_sampling = self.source_rate(path))
+            sound = self.data_convert2float32(sound)
+            self.save_scipy(sound, index)
+
+        elif option == "stream":
+            frames = self.stream_file(index, path)
+            metrics.count("files")
+            if self.on_written is not None:
+                self.on_written(index)
+
+            return os.getpid(), time.time() - start, frames / self.target_sampling
+
+        metrics.count("files")
+
+        return os.getpid(), time.time() - start, len(sound) / self.target_sampling
 
-        else: raise "option을 librosa나 scipy 둘 중 하나로 입력하세요."
+
+    def process_group (self, group, option):
+        """
+        A group of (index, path) with the same length, channels and sampling rate.
+        For the poly option the whole group is stacked and resampled in one 2-D call.
+            return list of process_file results
+        """
+        if option != "poly" or len(group) == 1:
+            return [self.process_file(index, path, option) for index, path in group]
+
+        start = time.time()
+        batch = np.stack([self.load_scipy(path) for _, path in group])
+        batch = self.data_normalize(batch)
+        batch = self.data_resampler_poly(batch, axis = 1, original_sampling = self.source_rate(group[0][1]))
+        batch = self.data_convert2float32(batch)
+        for (index, _), sound in zip(group, batch):
+            self.save_scipy(sound, index)
+
+        seconds = (time.time() - start) / len(group)
+        metrics.count("files", len(group))
+
+        return [(os.getpid(), seconds, batch.shape[1] / self.target_sampling)] * len(group)
+
+
+    def assign_indices (self, manifest):
+        """
+        Output index of every file in self.file_list.
+        A file in the manifest keeps its recorded index. Any other file takes its position in self.file_list,
+        unless a recorded file already uses that index, then it gets the next index after all used ones.
+        (A restart after a crash gives the same names, files added later never overwrite older outputs.)
+            return list of (index, path)
+        """
+        recorded = {}
+        for path in self.file_list:
+            record = manifest.get(path)
+            if record is not None and "index" in record["extra"]:
+                recorded[path] = record["extra"]["index"]
+
+        used       = set(recorded.values())
+        next_index = max(list(used) + [len(self.file_list) - 1]) + 1
+        items      = []
+
+        for position, path in enumerate(self.file_list):
+            if path in recorded:
+                index = recorded[path]
+            elif position not in used:
+                index = position
+            else:
+                index       = next_index
+                next_index += 1
+            used.add(index)
+            items.append((index, path))
+
+        return items
+
+
+    def make_groups (self, option, items):
+        """
+        Every (index, path) is its own group, except for the poly option where consecutive files
+        with the same header (frames, channels, dtype, sampling rate) are put together, at most batch_size per group.
+        Files of the fast path are never batched.
+        """
+        groups = []
+        last   = None
+
+        for index, path in items:
+            key = None
+            if option == "poly" and self.batch_size > 1 and not(self.is_passthrough(path, option)):
+                header = self.probe(path)
+                if header is not None:
+                    key = (header["frames"], header["channels"], header["dtype"], self.source_rate(path))
+
+            if key is not None and key == last and len(groups[-1]) < self.batch_size:
+                groups[-1].append((index, path))
+            else:
+                groups.append([(index, path)])
+            last = key
+
+        return groups
+
+
+    def data_save (self, option = "librosa", workers = 1, use_hash = False, write_workers = 2, write_depth = 64,
+                         num_shards = 1, shard_index = 0):
+        """
+        Every file is independent, so with workers > 1 the files are spread over a process pool.
+        Output names still come from the index in self.file_list (see assign_indices).
+        Files already in the manifest with the same options and unchanged sources are skipped.
+        With workers = 1 the output files are written by write_workers threads (write_behind.py) while the
+        next files are resampled, at most write_depth files wait. A file is recorded once it is written.
+        num_shards, shard_index : split the job over num_shards machines, this run takes every num_shards-th file
+        of self.file_list starting at shard_index, with its global output index and its own manifest.
+        (Merge the manifests (manifest.py --merge) before a rerun with a changed source folder.)
+        """
+        print("Option is ", option)
+        if option not in ["librosa", "scipy", "poly", "stream"]:
+            raise ValueError("option을 librosa, scipy, poly, stream 중 하나로 입력하세요.")
+
+        manifest = run_manifest(self.save_file_path, {"option"            : option,
+                                                      "original_sampling" : self.original_sampling,
+                                                      "target_sampling"   : self.target_sampling,
+                                                      "precision"         : self.precision.name,
+                                                      "output_dtype"      : self.output_dtype,
+                                                      "codec"             : self.output_codec,
+                                                      "fast_path"         : self.fast_path},
+                                use_hash = use_hash, num_shards = num_shards, shard_index = shard_index)
+        items    = self.assign_indices(manifest)
+        items    = [items[position] for position in shard_indices(len(items), num_shards, shard_index)]
+        if num_shards > 1:
+            print("Job shard " + str(shard_index) + " of " + str(num_shards))
+        todo     = [(index, path) for index, path in items if not manifest.is_done(path, [path], [self.output_path(index)])]
+        print(str(len(items) - len(todo)) + " files already done, " + str(len(todo)) + " files to resample")
+
+        # Grouped by source rate, so each group uses one resampling configuration (names still come from the index)
+        rates = {path : self.group_rate(path) for _, path in todo}
+        todo  = sorted(todo, key = lambda item : rates[item[1]] or 0)
+        for rate, count in sorted(collections.Counter(rates.values()).items(), key = lambda item : item[0] or 0):
+            print("source rate {} ::: {} files".format(rate, count))
+        if self.fast_path != "none":
+            print(str(sum(self.is_passthrough(path, option) for _, path in todo)) + " files already at the target format (" + self.fast_path + ")")
+
+        def record (group):
+            for index, path in group:
+                manifest.record(path, [path], [self.output_path(index)], index = index)
+
+        start   = time.time()
+        results = []
+        tasks   = [(group, option) for group in self.make_groups(option, todo)]
+
+        if workers <= 1:
+            paths           = dict(todo)
+            self.on_written = lambda index : record([(index, paths[index])])
+            try:
+                with write_behind(workers = write_workers, depth = write_depth) as self.writer:
+                    for task in tqdm(tasks):
+                        results.extend(self.process_group(*task))
+            finally:
+                self.writer, self.on_written = None, None
+
+        else:
+            with multiprocessing.Pool(workers, initializer = _worker_init, initargs = (self, metrics.config())) as pool:
+                for group, result in tqdm(pool.imap_unordered(_worker_process_group, tasks, chunksize = 4), total = len(tasks)):
+                    results.extend(result)
+                    record(group)
+                pool.close()
+                pool.join()
+
+        manifest.close()
+        self.report_throughput(results, time.time() - start)
+
+
+    def report_throughput (self, results, wall_time):
+        """
+        Files/s and audio seconds/s of every worker process, to size jobs on many core nodes
+        """
+        workers = {}
+        for pid, seconds, audio_seconds in results:
+            files, busy, audio = workers.get(pid, (0, 0.0, 0.0))
+            workers[pid]       = (files + 1, busy + seconds, audio + audio_seconds)
+
+        for pid, (files, busy, audio) in sorted(workers.items()):
+            print("worker {:>7d} ::: {:6d} files, {:8.2f} files/s, {:8.2f} audio s/s".format(
+                  pid, files, files / max(busy, 1e-9), audio / max(busy, 1e-9)))
+
+        total_audio = sum(audio for _, _, audio in results)
+        print("total  ::: {:6d} files in {:.2f} s, {:8.2f} files/s, {:8.2f} audio s/s".format(
+              len(results), wall_time, len(results) / max(wall_time, 1e-9), total_audio / max(wall_time, 1e-9)))
+
+
+_worker_factory = None
+
+def _worker_init (factory, metrics_config = None):
+    global _worker_factory
+    _worker_factory = factory
+    metrics.worker_start(metrics_config)
+
+
+def _worker_process_group (task):
+    return task[0], _worker_factory.process_group(*task)
 
 
 if __name__ == "__main__":
@@ -172,9 +585,24 @@ if __name__ == "__main__":
     parser.add_argument("--bp",    type = str, default = "./original",       help = "Input original file path")
     parser.add_argument("--sp",    type = str, default = "./datasets/clean", help = "Input resampling file path")
     parser.add_argument("--sn",    type = str, default = "test_clean",       help = "Input resampling file name")
-    parser.add_argument("--os", type = int, default = 16000, help = "Input original sound sampling rate")
+    parser.add_argument("--os", type = int, default = None,  help = "Input original sound sampling rate (None : read from every file header)")
     parser.add_argument("--ts", type = int, default = 16000, help = "Input targeting sound sampling rate")
-    parser.add_argument("--op", type = str, default = "librosa", help = "Input library factory librosa or scipy")
+    parser.add_argument("--op", type = str, default = "librosa", help = "Input library factory librosa, scipy, poly or stream")
+    parser.add_argument("--workers", type = int, default = 1, help = "Input number of resampling processes")
+    parser.add_argument("--batch",   type = int, default = 16, help = "Input same length files per poly batch")
+    parser.add_argument("--block",   type = int, default = 65536, help = "Input frames per block for the stream option")
+    parser.add_argument("--hash",    type = int, default = 0, help = "Input 1 : detect changed files by sha1 instead of size and mtime")
+    parser.add_argument("--precision",        type = str,   default = "float32", help = "Input normalize and resample dtype float32 or float64")
+    parser.add_argument("--out_dtype",        type = str,   default = "float32", help = "Input output sample dtype float32 or int16")
+    parser.add_argument("--codec",            type = str,   default = None, help = "Input output codec wav-float32, wav-int16 or flac (None : wav of out_dtype)")
+    parser.add_argument("--fast",             type = str,   default = "link", help = "Input files already at the target format : link, copy or none (resample anyway)")
+    parser.add_argument("--num_shards",  "--num-shards",  type = int, default = 1, help = "Input number of machines the job is split over")
+    parser.add_argument("--shard_index", "--shard-index", type = int, default = 0, help = "Input job shard of this machine (0 ~ num_shards - 1)")
+    parser.add_argument("--write_workers",    type = int,   default = 2,    help = "Input threads writing output files behind the resampling (workers 1)")
+    parser.add_argument("--write_depth",      type = int,   default = 64,   help = "Input files waiting to be written at most")
+    parser.add_argument("--metrics",          type = str,   default = None, help = "Input folder of per stage metrics (json and Prometheus textfile)")
+    parser.add_argument("--metrics_interval", type = float, default = 30,   help = "Input seconds between two metrics exports")
+    parser.add_argument("--profile",          type = int,   default = 0,    help = "Input 1 : also write a cProfile dump per process to the metrics folder")
     args = parser.parse_args()
 
     base_file_path    = args.bp
@@ -183,13 +611,42 @@ if __name__ == "__main__":
     original_sampling = args.os
     target_sampling   = args.ts
     option            = args.op
+    workers           = args.workers
+    batch_size        = args.batch
+    block_frames      = args.block
+    use_hash          = bool(args.hash)
+    precision         = args.precision
+    output_dtype      = args.out_dtype
+    output_codec      = args.codec
+    fast_path         = args.fast
+    num_shards        = args.num_shards
+    shard_index       = args.shard_index
+    write_workers     = args.write_workers
+    write_depth       = args.write_depth
     print(option)
 
+    if args.metrics is not None or args.profile:
+        metrics.enable(export_path = args.metrics, interval = args.metrics_interval, profile = bool(args.profile))
+
     resampling_factory = resampler(base_file_path = base_file_path,
                                    save_file_path = save_file_path,  
                                    save_file_name = save_file_name,
                                    original_sampling = original_sampling,
-                                   target_sampling = target_sampling)
+                                   target_sampling = target_sampling,
+                                   batch_size = batch_size,
+                                   block_frames = block_frames,
+                                   precision = precision,
+                                   output_dtype = output_dtype,
+                                   output_codec = output_codec,
+                                   fast_path = fast_path)
     
-    resampling_factory.data_save(option = option)
+    resampling_factory.data_save(option        = option,
+                                 workers       = workers,
+                                 use_hash      = use_hash,
+                                 write_workers = write_workers,
+                                 write_depth   = write_depth,
+                                 num_shards    = num_shards,
+                                 shard_index   = shard_index)
+    metrics.close()
+    metrics.summary()
     print("-- THe END --")
@@ -0,0 +1,109 @@
+import threading
+import numpy as np
+from tqdm import tqdm
+
+import scipy
+import scipy.fft
+
+from polyphase import polyphase_resampler
+from codec import read_sound
+
+class rir_bank ():
+    """
+    Room impulse responses, loaded once, for reverberant clean speech before data_mixing.
+        file_list     : RIR sound files (*.wav, *.flac), the first channel is used
+        sampling_rate : rate of the crops, RIRs of another rate are resampled (polyphase.py)
+        max_length    : RIRs are cut to this many samples (None keeps the whole tail)
+
+    Every RIR starts at its direct path (the samples before the peak are removed, so the reverberant
+    speech stays aligned with the dry speech) and is scaled to a peak of 1.
+
+    def spectra  : rfft of the RIRs of a batch for one FFT size. Each RIR is transformed on its first use and cached
+                   per FFT size, so a process holds at most len(self) * (nfft // 2 + 1) * 8 bytes per FFT size
+                   (1000 RIRs at nfft 32768 : 131 MB), only for the RIRs it has used. Every pool worker has its own cache
+    def convolve : convolve rows of a (B, length) batch with their RIRs in place, one rfft / irfft call for the batch.
+                   Linear convolution (FFT size >= length + RIR length - 1), the output is cut to the first length samples
+    """
+    def __init__ (self, file_list, sampling_rate = 16000, max_length = None):
+        self.file_list     = file_list
+        self.sampling_rate = sampling_rate
+        self.max_length    = max_length
+        self.cache         = {}
+        self.lock          = threading.Lock()
+        self.rirs          = []
+
+        resampler = polyphase_resampler()
+        for path in tqdm(self.file_list):
+            rate, sound = read_sound(path)
+            sound       = np.asarray(sound, dtype = np.float64)
+            if sound.ndim > 1:
+                sound = sound[:, 0]
+            if rate != self.sampling_rate:
+                sound = resampler.resample(sound, rate, self.sampling_rate)
+
+            sound = sound[np.argmax(np.abs(sound)):]
+            if self.max_length is not None:
+                sound = sound[:self.max_length]
+            sound = sound / max(np.abs(sound).max(), 1e-12)
+            self.rirs.append(sound.astype(np.float32))
+
+        if not self.rirs:
+            raise ValueError("no room impulse response in " + str(self.file_list))
+        self.length = max(len(rir) for rir in self.rirs)
+
+
+    def __len__ (self):
+        return len(self.rirs)
+
+
+    def __getstate__ (self):
+        # The spectra are computed again in every worker, only the RIRs are sent
+        state          = dict(self.__dict__)
+        state["cache"] = {}
+        del state["lock"]
+
+        return state
+
+
+    def __setstate__ (self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+    def fft_size (self, length):
+        return scipy.fft.next_fast_len(length + self.length - 1, real = True)
+
+
+    def spectra (self, nfft, rir_ids):
+        """
+        (len(rir_ids), nfft // 2 + 1) complex64, the missing RIRs are transformed in one rfft call
+        """
+        with self.lock:
+            cache   = self.cache.setdefault(nfft, {})
+            missing = sorted(set(rir_ids).difference(cache))
+            if missing:
+                rirs = np.zeros((len(missing), self.length), dtype = np.float32)
+                for row, rir_id in enumerate(missing):
+                    rirs[row, :len(self.rirs[rir_id])] = self.rirs[rir_id]
+                for rir_id, spectrum in zip(missing, scipy.fft.rfft(rirs, nfft, axis = 1)):
+                    cache[rir_id] = spectrum
+
+            return np.stack([cache[rir_id] for rir_id in rir_ids])
+
+
+    def convolve (self, batch, rows, rir_ids):
+        """
+        batch   : (B, length) crops
+        rows    : rows of batch to convolve
+        rir_ids : RIR of each of those rows
+        """
+        if len(rows) == 0:
+            return batch
+
+        length = batch.shape[1]
+        nfft   = self.fft_size(length)
+        sound  = scipy.fft.rfft(batch[rows], nfft, axis = 1)
+        sound *= self.spectra(nfft, rir_ids)
+        batch[rows] = scipy.fft.irfft(sound, nfft, axis = 1)[:, :length]
+
+        return batch
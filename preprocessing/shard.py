@@ -0,0 +1,165 @@
+import os, json, uuid
+import numpy as np
+
+import metrics
+from wav_io import convert_samples
+
+class shard_writer ():
+    """
+    Packed dataset output, an alternative to one noisy wav and one clean wav per example.
+        shard_path/shard_info.json       : split_length, shard_size, dtype, sampling_rate, count
+        shard_path/noisy_{:05d}.npy      : (shard_size, split_length) noisy rows
+        shard_path/clean_{:05d}.npy      : (shard_size, split_length) clean rows
+        shard_path/meta_{:05d}.jsonl     : one json line per row (index, SNR, clean path, noise id, offsets)
+
+    Example "index" is always row (index % shard_size) of shard (index // shard_size),
+    so a reader finds any example in O(1). The last shard may have fewer rows.
+
+    def append : Put one example into the current shard buffer, the shard is written when it is full.
+    def close  : Write the last (partial) shard and shard_info.json
+    def files  : noisy, clean and meta file of a shard
+    on_flush(shard_index, meta) is called after every written shard (used to record it in a manifest).
+    """
+    def __init__ (self, shard_path, split_length, shard_size = 4096, dtype = "float32", sampling_rate = 16000, on_flush = None):
+        if dtype not in ["float32", "int16"]:
+            raise ValueError("dtype must be float32 or int16, not " + str(dtype))
+
+        self.shard_path    = shard_path
+        self.split_length  = split_length
+        self.shard_size    = shard_size
+        self.dtype         = dtype
+        self.sampling_rate = sampling_rate
+        self.on_flush      = on_flush
+
+        if not(os.path.isdir(self.shard_path)):
+            os.makedirs(self.shard_path)
+
+        self.shard_index = None
+        self.rows        = 0
+        self.count       = 0
+        self.noisy       = np.zeros((self.shard_size, self.split_length), dtype = self.dtype)
+        self.clean       = np.zeros((self.shard_size, self.split_length), dtype = self.dtype)
+        self.meta        = []
+
+
+    def convert (self, sound):
+        """
+        float32 (-1 ~ 1) to the shard dtype
+        """
+        return convert_samples(sound, self.dtype)
+
+
+    def append (self, index, noisy, clean, meta):
+        shard_index = index // self.shard_size
+        row         = index %  self.shard_size
+
+        if self.shard_index is not None and shard_index != self.shard_index:
+            self.flush()
+        self.shard_index = shard_index
+
+        self.noisy[row] = self.convert(noisy)
+        self.clean[row] = self.convert(clean)
+        self.meta.append(dict(meta, index = int(index)))
+        self.rows       = max(self.rows, row + 1)
+        self.count      = max(self.count, int(index) + 1)
+
+
+    def files (self, shard_index):
+        name = "{:05d}".format(shard_index)
+
+        return [os.path.join(self.shard_path, "noisy_" + name + ".npy"),
+                os.path.join(self.shard_path, "clean_" + name + ".npy"),
+                os.path.join(self.shard_path, "meta_"  + name + ".jsonl")]
+
+
+    def flush (self):
+        if self.shard_index is None:
+            return
+
+        noisy_file, clean_file, meta_file = self.files(self.shard_index)
+        meta                              = sorted(self.meta, key = lambda meta : meta["index"])
+        with metrics.timer("write"):
+            np.save(noisy_file, self.noisy[:self.rows])
+            np.save(clean_file, self.clean[:self.rows])
+            with open(meta_file, "w") as f:
+                for row in meta:
+                    f.write(json.dumps(row) + "\n")
+
+        if self.on_flush is not None:
+            self.on_flush(self.shard_index, meta)
+
+        self.shard_index = None
+        self.rows        = 0
+        self.meta        = []
+
+
+    def close (self, count = None):
+        """
+        count : total number of examples, if shards before the last one were written by an earlier run
+        """
+        self.flush()
+        if count is not None:
+            self.count = count
+
+        info = {"split_length"  : self.split_length,
+                "shard_size"    : self.shard_size,
+                "dtype"         : self.dtype,
+                "sampling_rate" : self.sampling_rate,
+                "count"         : self.count}
+        # Every job shard of a multi machine run writes the same info, a unique temporary name keeps the writes apart
+        info_file = os.path.join(self.shard_path, "shard_info.json")
+        temp_file = info_file + "." + uuid.uuid4().hex + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(info, f, indent = 4)
+        os.replace(temp_file, info_file)
+
+
+class shard_reader ():
+    """
+    Read a packed dataset written by shard_writer.
+    Every shard is opened with np.load(mmap_mode = "r") on first use, so reader[index] only touches one row.
+        noisy, clean = reader[index]
+        meta         = reader.meta(index)
+    """
+    def __init__ (self, shard_path):
+        self.shard_path = shard_path
+
+        with open(os.path.join(self.shard_path, "shard_info.json"), "r") as f:
+            self.info = json.load(f)
+        self.shard_size = self.info["shard_size"]
+
+        self.shards = {}
+        self.metas  = {}
+
+
+    def __len__ (self):
+        return self.info["count"]
+
+
+    def shard (self, shard_index):
+        if shard_index not in self.shards:
+            name = "{:05d}".format(shard_index)
+            self.shards[shard_index] = (np.load(os.path.join(self.shard_path, "noisy_" + name + ".npy"), mmap_mode = "r"),
+                                        np.load(os.path.join(self.shard_path, "clean_" + name + ".npy"), mmap_mode = "r"))
+
+        return self.shards[shard_index]
+
+
+    def __getitem__ (self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError("index " + str(index) + " is out of range for " + str(len(self)) + " examples")
+
+        noisy, clean = self.shard(index // self.shard_size)
+        row          = index % self.shard_size
+
+        return noisy[row], clean[row]
+
+
+    def meta (self, index):
+        shard_index = index // self.shard_size
+
+        if shard_index not in self.metas:
+            with open(os.path.join(self.shard_path, "meta_" + "{:05d}".format(shard_index) + ".jsonl"), "r") as f:
+                self.metas[shard_index] = [json.loads(line) for line in f]
+
+        return self.metas[shard_index][index % self.shard_size]
@@ -0,0 +1,187 @@
+"""
+Header only wav access.
+    read_wav_header : sampling rate, channels, dtype, position and number of frames without decoding the sound
+    read_wav_window : seek to a frame and read only "length" frames
+    wav_header_bytes: the 44 byte header of a PCM or float wav file
+    wav_writer      : append frames to a wav file block by block, the sizes are patched on close
+    convert_samples : float sound (-1 ~ 1) to the float32 or int16 samples of an output file
+"""
+import os, struct
+import numpy as np
+
+WAVE_FORMAT_PCM        = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def wav_dtype (format_tag, bits):
+    """
+    numpy dtype of the samples, None if numpy can not map it directly (24bit PCM, A-law, ...)
+    """
+    if format_tag == WAVE_FORMAT_PCM:
+        return {8 : "u1", 16 : "<i2", 32 : "<i4"}.get(bits)
+
+    elif format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        return {32 : "<f4", 64 : "<f8"}.get(bits)
+
+    return None
+
+
+def dtype_format (dtype):
+    """
+    (format_tag, bits) of a numpy dtype, the reverse of wav_dtype
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return WAVE_FORMAT_IEEE_FLOAT, dtype.itemsize * 8
+    elif dtype.kind in ["i", "u"]:
+        return WAVE_FORMAT_PCM, dtype.itemsize * 8
+
+    raise ValueError("wav files can not store " + str(dtype))
+
+
+def wav_header_bytes (sampling_rate, channels, bits, format_tag = WAVE_FORMAT_PCM, data_size = 0):
+    """
+    RIFF + fmt + data chunk headers (44 bytes), the sound data follows directly
+    """
+    block_align = channels * bits // 8
+
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size + data_size % 2, b"WAVE",
+                       b"fmt ", 16, format_tag, channels, sampling_rate, sampling_rate * block_align, block_align, bits,
+                       b"data", data_size)
+
+
+def read_wav_header (path):
+    """
+    Read the RIFF chunks up to the "data" chunk.
+        return dict(sampling_rate, channels, bits, dtype, data_offset, frames)
+        dtype is None for sample formats numpy can not read directly
+    """
+    file_size = os.path.getsize(path)
+
+    with open(path, "rb") as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise ValueError(str(path) + " is not a RIFF/WAVE file")
+
+        header = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError(str(path) + " has no data chunk")
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                format_tag, channels, sampling_rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    # The real format is the first two bytes of the SubFormat GUID
+                    format_tag = struct.unpack("<H", fmt[24:26])[0]
+                header = {"sampling_rate" : sampling_rate,
+                          "channels"      : channels,
+                          "bits"          : bits,
+                          "block_align"   : block_align,
+                          "dtype"         : wav_dtype(format_tag, bits)}
+                if chunk_size % 2:
+                    f.seek(1, 1)
+
+            elif chunk_id == b"data":
+                if header is None:
+                    raise ValueError(str(path) + " has a data chunk before the fmt chunk")
+                data_offset = f.tell()
+                # Writers that stream without patching the header leave 0 or 0xFFFFFFFF, trust the file size then
+                if chunk_size in [0, 0xFFFFFFFF]:
+                    data_size = file_size - data_offset
+                else:
+                    data_size = min(chunk_size, file_size - data_offset)
+                header["data_offset"] = data_offset
+                header["frames"]      = data_size // header["block_align"]
+
+                return header
+
+            else:
+                f.seek(chunk_size + chunk_size % 2, 1)
+
+
+def read_wav_window (path, offset, length, header = None):
+    """
+    Frames [offset, offset + length) of the wav file, only these bytes are read.
+    Mono sound is returned as (frames, ), otherwise (frames, channels) like scipy.io.wavfile.read
+    """
+    if header is None:
+        header = read_wav_header(path)
+    if header["dtype"] is None:
+        raise ValueError(str(path) + " has a sample format that can not be read by window")
+
+    offset = max(0, min(offset, header["frames"]))
+    length = max(0, min(length, header["frames"] - offset))
+
+    with open(path, "rb") as f:
+        f.seek(header["data_offset"] + offset * header["block_align"])
+        sound = np.fromfile(f, dtype = header["dtype"], count = length * header["channels"])
+
+    if header["channels"] > 1:
+        sound = sound.reshape(-1, header["channels"])
+
+    return sound
+
+
+def convert_samples (sound, dtype = "float32"):
+    """
+    float32 keeps the sound (no copy if it already is float32),
+    int16 is clipped to -1 ~ 1, scaled by 32767 and rounded (half the size of a float32 file)
+    """
+    if dtype == "float32":
+        return np.asarray(sound, dtype = np.float32)
+    if dtype != "int16":
+        raise ValueError("output dtype must be float32 or int16, not " + str(dtype))
+
+    scaled  = np.clip(sound, -1, 1)
+    scaled *= 32767
+    np.rint(scaled, out = scaled)
+
+    return scaled.astype(np.int16)
+
+
+class wav_writer ():
+    """
+    Write a wav file block by block, so a long sound never has to be in memory at once.
+    The header is written first with empty sizes and patched in close.
+        with wav_writer(path, 16000, channels = 1, dtype = "float32") as writer:
+            writer.write(block)
+    """
+    def __init__ (self, path, sampling_rate, channels = 1, dtype = "float32"):
+        self.path          = path
+        self.sampling_rate = sampling_rate
+        self.channels      = channels
+        self.dtype         = np.dtype(dtype).newbyteorder("<")
+        self.format_tag, self.bits = dtype_format(self.dtype)
+        self.data_size     = 0
+
+        self.file = open(self.path, "wb")
+        self.file.write(wav_header_bytes(self.sampling_rate, self.channels, self.bits, self.format_tag))
+
+
+    def write (self, data):
+        data = np.ascontiguousarray(data, dtype = self.dtype)
+        self.file.write(data.tobytes())
+        self.data_size += data.nbytes
+
+
+    def close (self):
+        if self.file is None:
+            return
+
+        if self.data_size % 2:
+            self.file.write(b"\x00")
+        self.file.seek(0)
+        self.file.write(wav_header_bytes(self.sampling_rate, self.channels, self.bits, self.format_tag, self.data_size))
+        self.file.close()
+        self.file = None
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, *args):
+        self.close()
@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class write_behind ():
+    """
+    Bounded write-behind queue. The caller computes the next item while earlier items are encoded and written
+    on a small thread pool (writing is waiting on the disk, so threads are enough).
+        submit(function, *args) : run function(*args) on the pool, blocks while "depth" writes are waiting or running
+        close()                 : wait for every submitted write, then raise the first error of any write
+
+    The first error of a write is raised again in the caller (at the next submit or at close),
+    writes that were still waiting are then skipped.
+    workers = 0 writes synchronously in submit (the old behaviour).
+
+    with write_behind(workers = 2, depth = 64) as writer:
+        for index in todo:
+            noisy, clean = ...
+            writer.submit(write_example, index, noisy, clean)
+    """
+    def __init__ (self, workers = 2, depth = 64):
+        self.workers  = workers
+        self.depth    = max(1, depth)
+        self.slots    = threading.BoundedSemaphore(self.depth)
+        self.errors   = []
+        self.executor = ThreadPoolExecutor(max_workers = workers) if workers > 0 else None
+
+
+    def submit (self, function, *args):
+        self.check()
+        if self.executor is None:
+            function(*args)
+            return
+
+        self.slots.acquire()
+        try:
+            self.executor.submit(self.run, function, args)
+        except BaseException:
+            self.slots.release()
+            raise
+
+
+    def run (self, function, args):
+        try:
+            if not self.errors:
+                function(*args)
+        except BaseException as error:
+            self.errors.append(error)
+        finally:
+            self.slots.release()
+
+
+    def check (self):
+        if self.errors:
+            raise self.errors[0]
+
+
+    def close (self):
+        if self.executor is not None:
+            self.executor.shutdown(wait = True)
+            self.executor = None
+        self.check()
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+
+        # Flush what was already submitted, the error of the caller wins
+        if self.executor is not None:
+            self.executor.shutdown(wait = True)
+            self.executor = None